@@ -1,60 +1,561 @@
-import boto3
+import argparse
+import csv
+import io
+import json
 import os
+import queue
+import signal
+import socket
+import tempfile
+import threading
 import time
-import torch
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
 from PIL import Image
-from facenet_pytorch import MTCNN, InceptionResnetV1
+from clients import LOCAL_ROOT, LazyClient, get_client, queue_url
+from telemetry import Heartbeat, build_sink
+
+# torch and facenet_pytorch are imported by FaceNetRecognizer, after the cheap startup work, see main
+process_started = time.time()
 
 # AWS Configuration
 ASU_ID = '1231674381'
 REGION = 'us-east-1'
 
-# Initialize AWS clients
-sqs = boto3.client('sqs', region_name=REGION)
-s3 = boto3.client('s3', region_name=REGION)
+# AWS clients, created on first use in each process (so forked workers get their own connection pools)
+sqs = LazyClient('sqs', REGION)
+s3 = LazyClient('s3', REGION)
 
-# SQS queue URLs
-request_queue_url = sqs.get_queue_url(QueueName=f'{ASU_ID}-req-queue')['QueueUrl']
-response_queue_url = sqs.get_queue_url(QueueName=f'{ASU_ID}-resp-queue')['QueueUrl']
+# SQS queues, their URLs are resolved once and cached (see clients.queue_url)
+request_queue = f'{ASU_ID}-req-queue'
+response_queue = f'{ASU_ID}-resp-queue'
 
 # S3 bucket names
 input_bucket_name = f'{ASU_ID}-in-bucket'
 output_bucket_name = f'{ASU_ID}-out-bucket'
 
-mtcnn = MTCNN(image_size=240, margin=0, min_face_size=20)  # For face detection
-resnet = InceptionResnetV1(pretrained='vggface2').eval()       # For embedding extraction
+# Images up to this size are decoded from memory, larger ones are spooled to a temp file
+spill_threshold = 8 * 1024 * 1024
 
-def face_match(img_path, data_path):
-    # Get embedding matrix of the given image
-    img = Image.open(img_path)
-    face, prob = mtcnn(img, return_prob=True)  # Returns cropped face and probability
-    emb = resnet(face.unsqueeze(0)).detach()  # Get embedding
-    saved_data = torch.load('data.pt')  # loading data.pt file
-    embedding_list = saved_data[0]  # getting embedding data
-    name_list = saved_data[1]  # getting list of names
-    dist_list = []  # list of matched distances, minimum distance is used to identify the person
+# The Recognizer built by main (see --recognizer) and how long building it took
+recognizer = None
+model_load_seconds = None
 
-    for idx, emb_db in enumerate(embedding_list):
-        dist = torch.dist(emb, emb_db).item()
-        dist_list.append(dist)
+# Set once this process has handled a message, see mark_first_message
+first_message_marked = False
 
-    idx_min = dist_list.index(min(dist_list))
-    return (name_list[idx_min], min(dist_list))
+def instance_id():
+    # IMDSv2: fetch a session token, then this instance's id
+    token_request = urllib.request.Request('http://169.254.169.254/latest/api/token', method='PUT',
+                                           headers={'X-aws-ec2-metadata-token-ttl-seconds': '60'})
+    token = urllib.request.urlopen(token_request, timeout=2).read().decode()
+    id_request = urllib.request.Request('http://169.254.169.254/latest/meta-data/instance-id',
+                                        headers={'X-aws-ec2-metadata-token': token})
+    return urllib.request.urlopen(id_request, timeout=2).read().decode()
 
-def main():
-    data_path = '/home/ubuntu/data.pt'   # Path to your embedding data file
+def tag_first_message(timestamp):
+    try:
+        ec2 = get_client('ec2', REGION)
+        ec2.create_tags(Resources=[instance_id()], Tags=[{'Key': 'FirstMessageAt', 'Value': f"{timestamp:.3f}"}])
+    except Exception as e:
+        print(f"Could not tag first message time: {e}")
 
-    # Ensure the data file exists
-    if not os.path.exists(data_path):
-        print(f"Embedding data file {data_path} not found.")
+def mark_first_message():
+    # Tag the instance with when it handled its first message, the controller uses it to time scale-outs
+    global first_message_marked
+    if first_message_marked:
+        return
+    first_message_marked = True
+    print(f"First message {time.time() - process_started:.1f}s after process start")
+    if LOCAL_ROOT:
+        return
+    threading.Thread(target=tag_first_message, args=(time.time(),), daemon=True).start()
+
+# How often a worker re-reads its AppTierDrain tag, see drain_requested
+DRAIN_CHECK_INTERVAL = 5
+drain_checked_at = 0.0
+drain_flag = False
+
+def drain_requested():
+    # The controller tags instances it is scaling in with AppTierDrain=requested; the tag is read from
+    # instance metadata (no API call) at most every DRAIN_CHECK_INTERVAL seconds
+    global drain_checked_at, drain_flag
+    if LOCAL_ROOT:
+        return False  # no instance metadata off EC2, local runs are stopped with a signal
+    if drain_flag or time.time() - drain_checked_at < DRAIN_CHECK_INTERVAL:
+        return drain_flag
+    drain_checked_at = time.time()
+    try:
+        token_request = urllib.request.Request('http://169.254.169.254/latest/api/token', method='PUT',
+                                               headers={'X-aws-ec2-metadata-token-ttl-seconds': '60'})
+        token = urllib.request.urlopen(token_request, timeout=1).read().decode()
+        tag_request = urllib.request.Request('http://169.254.169.254/latest/meta-data/tags/instance/AppTierDrain',
+                                             headers={'X-aws-ec2-metadata-token': token})
+        drain_flag = urllib.request.urlopen(tag_request, timeout=1).read().decode() == 'requested'
+    except Exception:
+        drain_flag = False  # no tag (404) or not running on EC2
+    if drain_flag:
+        print("Drain requested, finishing in-flight work and exiting")
+    return drain_flag
+
+def finish_drain():
+    # Tell the controller this instance is idle and can be stopped or terminated
+    try:
+        ec2 = get_client('ec2', REGION)
+        ec2.create_tags(Resources=[instance_id()], Tags=[{'Key': 'AppTierDrain', 'Value': 'drained'}])
+        print("Drained, marked instance for retirement")
+    except Exception as e:
+        print(f"Could not mark instance as drained: {e}")
+
+# Per-process throughput and stage latency reporter, see start_heartbeat
+heartbeat = None
+
+def start_heartbeat(spec, interval):
+    # Each worker process reports on its own; the controller groups heartbeats by instance id and pid
+    global heartbeat
+    if not spec:
+        return
+    try:
+        worker_instance = socket.gethostname() if LOCAL_ROOT else instance_id()
+    except Exception:
+        worker_instance = socket.gethostname()  # not running on EC2
+    heartbeat = Heartbeat(build_sink(spec, REGION), worker_instance, interval, model_load_seconds).start()
+
+def record_stage(stage, seconds):
+    if heartbeat is not None:
+        heartbeat.record_stage(stage, seconds)
+
+def record_images(count):
+    if heartbeat is not None:
+        heartbeat.record_images(count)
+
+def fetch_image(image_key):
+    # Stream the object straight into memory, no /tmp file to write, reopen and remove
+    obj = s3.get_object(Bucket=input_bucket_name, Key=image_key)
+    body = obj['Body']
+    if obj['ContentLength'] <= spill_threshold:
+        img = Image.open(io.BytesIO(body.read()))
+        img.load()
+        return img
+    # Large images go through a uniquely named temp file, so equal keys never collide
+    with tempfile.NamedTemporaryFile(suffix=os.path.splitext(image_key)[1]) as f:
+        for chunk in body.iter_chunks():
+            f.write(chunk)
+        f.flush()
+        img = Image.open(f.name)
+        img.load()  # decode before the temp file is deleted
+        return img
+
+def fetch_request_image(message):
+    # Small images arrive inline in the message, everything else is a claim check on the input bucket
+    payload = message.get('MessageAttributes', {}).get('Payload')
+    if payload is None:
+        return fetch_image(message['Body'])
+    img = Image.open(io.BytesIO(payload['BinaryValue']))
+    img.load()
+    return img
+
+def try_fetch_request_image(message):
+    # None instead of an exception, so one unreadable request does not take its whole batch down
+    try:
+        return fetch_request_image(message)
+    except Exception as e:
+        print(f"Error fetching image for {message['Body']}: {e}")
+        return None
+
+def upload_result(result):
+    result_key, classification_result = result
+    try:
+        s3.put_object(Bucket=output_bucket_name, Key=result_key, Body=classification_result)
+        return True
+    except Exception as e:
+        print(f"Error uploading result {result_key}: {e}")
+        return False
+
+class Recognizer:
+    """Classifies request images; match_batch returns one (name, distance) per image, or None where no face was found."""
+
+    def set_threads(self, count):
+        pass  # only backends with an intra-op thread pool need to split the cores
+
+    def match(self, img, image_key):
+        return self.match_batch([img], [image_key])[0]
+
+    def match_batch(self, images, image_keys):
+        raise NotImplementedError
+
+class FaceNetRecognizer(Recognizer):
+    """MTCNN detection and InceptionResnetV1 embeddings searched against the data.pt gallery."""
+
+    def __init__(self, data_path, index='exact', index_options=None, threads=None):
+        # Imported here rather than at module import, they take seconds and the stub backend never needs them
+        import torch
+        from facenet_pytorch import MTCNN, InceptionResnetV1
+        from gallery_store import get_gallery_store
+        self.torch = torch
+        if threads is not None:
+            # Before any torch op runs: an OpenMP pool started at full width here would be inherited,
+            # broken, by every forked worker (libgomp is not fork-safe)
+            self.set_threads(threads)
+        # Load the gallery up front, while the models are built, so the first request (and every forked
+        # worker) does not pay for it
+        self.gallery = get_gallery_store(data_path, index=index, index_options=index_options)
+        with ThreadPoolExecutor(max_workers=1) as loader:
+            gallery_loaded = loader.submit(self.gallery.get)
+            self.mtcnn = MTCNN(image_size=240, margin=0, min_face_size=20)  # For face detection
+            self.resnet = InceptionResnetV1(pretrained='vggface2').eval()       # For embedding extraction
+            gallery_loaded.result()
+
+    def set_threads(self, count):
+        self.torch.set_num_threads(count)
+
+    def match(self, img, image_key):
+        # Get embedding matrix of the given image (a PIL image or a path to one)
+        if not isinstance(img, Image.Image):
+            img = Image.open(img)
+        face, prob = self.mtcnn(img, return_prob=True)  # Returns cropped face and probability
+        emb = self.resnet(face.unsqueeze(0)).detach()  # Get embedding
+        return self.gallery.get().match(emb)  # single batched distance + argmin
+
+    def detect_faces(self, images):
+        # MTCNN can only batch images of identical size, otherwise detect one at a time
+        if len(images) > 1 and len({img.size for img in images}) == 1:
+            faces, probs = self.mtcnn(images, return_prob=True)
+            return list(faces)
+        return [self.mtcnn(img, return_prob=True)[0] for img in images]
+
+    def match_batch(self, images, image_keys):
+        faces = self.detect_faces(images)
+        found = [i for i, face in enumerate(faces) if face is not None]
+        results = [None] * len(images)
+        if found:
+            with self.torch.no_grad():
+                embs = self.resnet(self.torch.stack([faces[i] for i in found]))  # one forward pass for the whole batch
+            matches = self.gallery.get().match_batch(embs)
+            for i, match in zip(found, matches):
+                results[i] = match
+        return results
+
+class StubRecognizer(Recognizer):
+    """Looks the answer up by image name in faceDataset.csv, like project2 part1/app.py, after a synthetic delay.
+
+    For load-testing the queueing and I/O path without paying for inference:
+    each call sleeps latency seconds plus image_latency per image, so a batch
+    costs what a batched model call would. Unknown names classify as 'Unknown'.
+    """
+
+    def __init__(self, results_path, latency=0.0, image_latency=0.0):
+        with open(results_path) as f:
+            self.results = {row['Image']: row['Results'] for row in csv.DictReader(f)}
+        self.latency = latency
+        self.image_latency = image_latency
+
+    def match_batch(self, images, image_keys):
+        delay = self.latency + self.image_latency * len(images)
+        if delay > 0:
+            time.sleep(delay)
+        return [(self.results.get(os.path.splitext(key)[0], 'Unknown'), 0.0) for key in image_keys]
+
+def receive_batch(batch_size, visibility_timeout=None):
+    # SQS returns at most 10 messages per call, keep pulling until the batch is full or the queue is empty
+    messages = []
+    wait_time = 5
+    extra = {} if visibility_timeout is None else {'VisibilityTimeout': visibility_timeout}
+    while len(messages) < batch_size:
+        response = sqs.receive_message(
+            QueueUrl=queue_url(request_queue, REGION),
+            MaxNumberOfMessages=min(10, batch_size - len(messages)),
+            WaitTimeSeconds=wait_time,
+            MessageAttributeNames=['RequestId', 'Payload'],
+            **extra
+        )
+        if 'Messages' not in response:
+            break
+        messages.extend(response['Messages'])
+        wait_time = 0  # Only long-poll for the first part of the batch
+    return messages
+
+def reply_attributes(message):
+    # Echo the web tier's correlation id back on the response so it can find the waiting request
+    request_id = message.get('MessageAttributes', {}).get('RequestId')
+    if request_id is None:
+        return {}
+    return {'RequestId': {'DataType': 'String', 'StringValue': request_id['StringValue']}}
+
+def chunks(items, size=10):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+def process_batch(messages, executor):
+    mark_first_message()
+    print(f"Received batch of {len(messages)} messages: {[message['Body'] for message in messages]}")
+
+    # Fetch every image in the batch concurrently into memory. A message whose image cannot be fetched is
+    # left alone, it becomes visible again after the visibility timeout and is retried
+    start = time.time()
+    fetched = list(executor.map(try_fetch_request_image, messages))
+    record_stage('download', time.time() - start)
+    messages = [message for message, img in zip(messages, fetched) if img is not None]
+    images = [img for img in fetched if img is not None]
+    print(f"Downloaded {len(images)} images from S3 bucket {input_bucket_name}")
+    if not messages:
         return
+    image_keys = [message['Body'] for message in messages]
+
+    # Perform face recognition on the whole batch
+    start = time.time()
+    try:
+        images = [img.convert('RGB') for img in images]
+        matches = recognizer.match_batch(images, image_keys)
+    except Exception as e:
+        print(f"Error in batch face recognition: {e}")
+        matches = [None] * len(messages)
+    record_stage('inference', time.time() - start)
+
+    results = []
+    for image_key, match in zip(image_keys, matches):
+        classification_result = match[0] if match else "Error in processing"
+        results.append((os.path.splitext(image_key)[0], classification_result))
+    print(f"Face recognition results: {results}")
+
+    # Upload results to S3 output bucket (S3 has no batch put, so do them concurrently)
+    start = time.time()
+    uploaded = list(executor.map(upload_result, results))
+    print(f"Uploaded {sum(uploaded)} classification results to S3 bucket {output_bucket_name}")
+
+    # Send responses and delete requests in bulk, 10 entries per call. Only a request that was answered is
+    # deleted; the rest become visible again and are retried
+    entries = [{'Id': str(i), 'MessageBody': f"{result_key}:{classification_result}",
+                'MessageAttributes': reply_attributes(message)}
+               for i, ((result_key, classification_result), message, ok) in enumerate(zip(results, messages, uploaded))
+               if ok]
+    sent = set()
+    for chunk in chunks(entries):
+        try:
+            response = sqs.send_message_batch(QueueUrl=queue_url(response_queue, REGION), Entries=chunk)
+        except Exception as e:
+            print(f"Failed to send {len(chunk)} response messages: {e}")
+            continue
+        sent.update(entry['Id'] for entry in response.get('Successful', []))
+        for failed in response.get('Failed', []):
+            print(f"Failed to send response message {failed['Id']}: {failed.get('Message')}")
+    print(f"Sent {len(sent)} response messages to queue {response_queue}")
 
+    entries = [{'Id': str(i), 'ReceiptHandle': message['ReceiptHandle']}
+               for i, message in enumerate(messages) if str(i) in sent]
+    for chunk in chunks(entries):
+        try:
+            response = sqs.delete_message_batch(QueueUrl=queue_url(request_queue, REGION), Entries=chunk)
+        except Exception as e:
+            print(f"Failed to delete {len(chunk)} request messages: {e}")
+            continue
+        for failed in response.get('Failed', []):
+            print(f"Failed to delete request message {failed['Id']}: {failed.get('Message')}")
+    print(f"Deleted {len(entries)} messages from request queue")
+    record_stage('publish', time.time() - start)
+    record_images(len(messages))
+
+def run_batched(batch_size):
+    # The batch stays invisible to other workers however long it takes, see VisibilityKeeper
+    keeper = VisibilityKeeper()
+    threading.Thread(target=keeper.run, daemon=True).start()
+    with ThreadPoolExecutor(max_workers=min(batch_size, 10)) as executor:
+        while not drain_requested():
+            messages = receive_batch(batch_size, keeper.timeout)
+            if messages:
+                for message in messages:
+                    keeper.hold(message)
+                try:
+                    process_batch(messages, executor)
+                finally:
+                    for message in messages:
+                        keeper.release(message)
+            else:
+                # No messages; wait before polling again
+                time.sleep(1)
+
+class StageStats:
+    """Busy/wait time and item counters for one pipeline stage."""
+
+    def __init__(self, name):
+        self.name = name
+        self.items = 0
+        self.busy = 0.0
+        self.waiting = 0.0
+        self.lock = threading.Lock()
+
+    def record(self, items, busy, waiting):
+        with self.lock:
+            self.items += items
+            self.busy += busy
+            self.waiting += waiting
+
+    def report(self, elapsed):
+        with self.lock:
+            return (f"{self.name}: {self.items} items, busy {self.busy:.1f}s ({100 * self.busy / elapsed:.0f}%), "
+                    f"waiting {self.waiting:.1f}s")
+
+class VisibilityKeeper:
+    """Keeps requests a worker is holding invisible to other workers.
+
+    prefetch_stage can buffer up to 2 * queue_depth requests ahead of
+    publishing, and a large --batch_size batch is detected, embedded and
+    published in one go; either can take longer than a visibility timeout,
+    and a request that reappears would be processed twice. Held messages are
+    received with an explicit timeout and renewed every half timeout until
+    they are released.
+    """
+
+    def __init__(self, timeout=60):
+        self.timeout = timeout
+        self.held = {}
+        self.lock = threading.Lock()
+
+    def hold(self, message):
+        with self.lock:
+            self.held[message['ReceiptHandle']] = message
+
+    def release(self, message):
+        with self.lock:
+            self.held.pop(message['ReceiptHandle'], None)
+
+    def run(self):
+        while True:
+            time.sleep(self.timeout / 2)
+            with self.lock:
+                handles = list(self.held)
+            entries = [{'Id': str(i), 'ReceiptHandle': handle, 'VisibilityTimeout': self.timeout}
+                       for i, handle in enumerate(handles)]
+            for chunk in chunks(entries):
+                try:
+                    response = sqs.change_message_visibility_batch(QueueUrl=queue_url(request_queue, REGION),
+                                                                   Entries=chunk)
+                except Exception as e:
+                    print(f"Error extending visibility of {len(chunk)} buffered requests: {e}")
+                    continue
+                for failed in response.get('Failed', []):
+                    print(f"Failed to extend visibility of buffered request {failed['Id']}: {failed.get('Message')}")
+
+def prefetch_stage(download_queue, stats, executor, keeper):
+    # Receive and download ahead of inference, blocking once download_queue is full
+    while not drain_requested():
+        wait_start = time.time()
+        response = sqs.receive_message(QueueUrl=queue_url(request_queue, REGION), MaxNumberOfMessages=10,
+                                       WaitTimeSeconds=5, VisibilityTimeout=keeper.timeout,
+                                       MessageAttributeNames=['RequestId', 'Payload'])
+        messages = response.get('Messages', [])
+        if not messages:
+            stats.record(0, 0.0, time.time() - wait_start)
+            continue
+        mark_first_message()
+        for message in messages:
+            keeper.hold(message)
+        start = time.time()
+        items = []
+        for message, img in zip(messages, executor.map(try_fetch_request_image, messages)):
+            if img is None:
+                # Let it become visible again after the visibility timeout
+                keeper.release(message)
+            else:
+                items.append((message, message['Body'], img))
+        stats.record(len(items), time.time() - start, start - wait_start)
+        record_stage('download', time.time() - start)
+        for item in items:
+            wait_start = time.time()
+            download_queue.put(item)
+            stats.record(0, 0.0, time.time() - wait_start)
+
+def inference_stage(download_queue, publish_queue, batch_size, stats):
+    # Take whatever is already downloaded (up to batch_size) and infer it in one pass
     while True:
+        wait_start = time.time()
+        items = [download_queue.get()]
+        while len(items) < batch_size:
+            try:
+                items.append(download_queue.get_nowait())
+            except queue.Empty:
+                break
+        start = time.time()
+        try:
+            images = [img.convert('RGB') for _, _, img in items]
+            matches = recognizer.match_batch(images, [image_key for _, image_key, _ in items])
+        except Exception as e:
+            print(f"Error in face recognition: {e}")
+            matches = [None] * len(items)
+        stats.record(len(items), time.time() - start, start - wait_start)
+        record_stage('inference', time.time() - start)
+        for item, match in zip(items, matches):
+            wait_start = time.time()
+            publish_queue.put((item, match[0] if match else "Error in processing"))
+            stats.record(0, 0.0, time.time() - wait_start)
+            download_queue.task_done()
+
+def publish_stage(publish_queue, stats, keeper):
+    # Upload the result, answer the web tier and retire the request message
+    while True:
+        wait_start = time.time()
+        (message, image_key, _), classification_result = publish_queue.get()
+        start = time.time()
+        try:
+            result_key = os.path.splitext(image_key)[0]  # Remove file extension
+            s3.put_object(Bucket=output_bucket_name, Key=result_key, Body=classification_result)
+            sqs.send_message(QueueUrl=queue_url(response_queue, REGION), MessageBody=f"{result_key}:{classification_result}",
+                             MessageAttributes=reply_attributes(message))
+            sqs.delete_message(QueueUrl=queue_url(request_queue, REGION), ReceiptHandle=message['ReceiptHandle'])
+            print(f"Published {result_key}:{classification_result}")
+        except Exception as e:
+            print(f"Error publishing result for {image_key}: {e}")
+        keeper.release(message)
+        stats.record(1, time.time() - start, start - wait_start)
+        record_stage('publish', time.time() - start)
+        record_images(1)
+        publish_queue.task_done()
+
+def run_pipelined(batch_size, queue_depth, report_interval=30):
+    # Bounded buffers keep at most queue_depth images downloaded ahead of the model
+    download_queue = queue.Queue(maxsize=queue_depth)
+    publish_queue = queue.Queue(maxsize=queue_depth)
+    stats = [StageStats('prefetch'), StageStats('inference'), StageStats('publish')]
+    executor = ThreadPoolExecutor(max_workers=10)
+    keeper = VisibilityKeeper()
+    stages = [
+        threading.Thread(target=prefetch_stage, args=(download_queue, stats[0], executor, keeper), daemon=True),
+        threading.Thread(target=inference_stage, args=(download_queue, publish_queue, batch_size, stats[1]), daemon=True),
+        threading.Thread(target=publish_stage, args=(publish_queue, stats[2], keeper), daemon=True),
+    ]
+    threading.Thread(target=keeper.run, daemon=True).start()
+    started = time.time()
+    for stage in stages:
+        stage.start()
+    while all(stage.is_alive() for stage in stages):
+        stages[0].join(timeout=report_interval)
+        elapsed = time.time() - started
+        print(f"Pipeline after {elapsed:.0f}s (queued: {download_queue.qsize()} downloaded, {publish_queue.qsize()} to publish)")
+        for stage_stats in stats:
+            print(f"  {stage_stats.report(elapsed)}")
+    if stages[0].is_alive() or not drain_requested():
+        raise RuntimeError("A pipeline stage exited unexpectedly, stopping worker")
+    # Draining: prefetch has stopped receiving, let the images already fetched run through
+    download_queue.join()
+    publish_queue.join()
+
+def run_worker(batch_size=1, pipeline=False, queue_depth=20, heartbeat_spec=None, heartbeat_interval=30):
+    start_heartbeat(heartbeat_spec, heartbeat_interval)
+    if pipeline:
+        run_pipelined(batch_size, queue_depth)
+        return
+
+    if batch_size > 1:
+        run_batched(batch_size)
+        return
+
+    while not drain_requested():
         # Receive messages from SQS request queue
         response = sqs.receive_message(
-            QueueUrl=request_queue_url,
+            QueueUrl=queue_url(request_queue, REGION),
             MaxNumberOfMessages=1,
-            WaitTimeSeconds=5
+            WaitTimeSeconds=5,
+            MessageAttributeNames=['RequestId', 'Payload']
         )
 
         if 'Messages' in response:
@@ -63,22 +564,27 @@ def main():
                 image_key = message['Body']  # This is the image filename, e.g., 'test_00.jpg'
 
                 print(f"Received message with image key: {image_key}")
+                mark_first_message()
 
-                # Download image from S3 input bucket
-                local_image_path = f'/tmp/{image_key}'
-                s3.download_file(input_bucket_name, image_key, local_image_path)
+                # Fetch image from S3 input bucket into memory
+                start = time.time()
+                img = fetch_request_image(message)
+                record_stage('download', time.time() - start)
                 print(f"Downloaded image {image_key} from S3 bucket {input_bucket_name}")
 
                 # Perform face recognition
+                start = time.time()
                 try:
-                    name, distance = face_match(local_image_path, data_path)
+                    name, distance = recognizer.match(img, image_key)
                     classification_result = name
                     print(f"Face recognition result: {classification_result}")
                 except Exception as e:
                     classification_result = "Error in processing"
                     print(f"Error in face recognition: {e}")
+                record_stage('inference', time.time() - start)
 
                 # Upload result to S3 output bucket
+                start = time.time()
                 result_key = os.path.splitext(image_key)[0]  # Remove file extension
                 s3.put_object(
                     Bucket=output_bucket_name,
@@ -90,24 +596,168 @@ def main():
                 # Send message to SQS response queue
                 response_message = f"{result_key}:{classification_result}"
                 sqs.send_message(
-                    QueueUrl=response_queue_url,
-                    MessageBody=response_message
+                    QueueUrl=queue_url(response_queue, REGION),
+                    MessageBody=response_message,
+                    MessageAttributes=reply_attributes(message)
                 )
-                print(f"Sent response message: {response_message} to queue {response_queue_url}")
+                print(f"Sent response message: {response_message} to queue {response_queue}")
 
                 # Delete processed message from request queue
                 sqs.delete_message(
-                    QueueUrl=request_queue_url,
+                    QueueUrl=queue_url(request_queue, REGION),
                     ReceiptHandle=receipt_handle
                 )
                 print(f"Deleted message from request queue")
-
-                # Clean up local files
-                os.remove(local_image_path)
-                print(f"Removed local image file {local_image_path}")
+                record_stage('publish', time.time() - start)
+                record_images(1)
         else:
             # No messages; wait before polling again
             time.sleep(1)
 
+def start_worker_process(slot, serve, threads_per_worker):
+    pid = os.fork()
+    if pid:
+        return pid
+    # Child: the model, gallery and queue URLs are inherited copy-on-write from the supervisor; the boto3
+    # clients (whose connection pools must not be shared) are created afresh on first use, per pid
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    recognizer.set_threads(threads_per_worker)
+    print(f"Worker {slot} started as pid {os.getpid()} with {threads_per_worker} torch threads")
+    status = 1
+    try:
+        serve()
+        status = 0  # serve only returns once the instance is draining
+    except Exception as e:
+        print(f"Worker {slot} failed: {e}")
+    finally:
+        os._exit(status)
+
+def run_supervisor(num_workers, serve, threads_per_worker):
+    # Fork num_workers inference processes and restart any that exit
+    children = {}
+    def stop_children(signum, frame):
+        for pid in children:
+            os.kill(pid, signal.SIGTERM)
+        raise SystemExit(0)
+    signal.signal(signal.SIGTERM, stop_children)
+    signal.signal(signal.SIGINT, stop_children)
+
+    for slot in range(num_workers):
+        children[start_worker_process(slot, serve, threads_per_worker)] = slot
+    while children:
+        pid, status = os.wait()
+        slot = children.pop(pid, None)
+        if slot is None:
+            continue
+        if status == 0:
+            print(f"Worker {slot} (pid {pid}) drained and exited")
+            continue
+        print(f"Worker {slot} (pid {pid}) exited with status {status}, restarting")
+        time.sleep(1)
+        children[start_worker_process(slot, serve, threads_per_worker)] = slot
+
+def warm_up_clients(timings):
+    # Runs while the recognizer loads: create the clients and resolve (or read the cached) queue URLs
+    start = time.time()
+    get_client('sqs', REGION)
+    get_client('s3', REGION)
+    queue_url(request_queue, REGION)
+    queue_url(response_queue, REGION)
+    timings['clients'] = round(time.time() - start, 3)
+
+def write_ready_file(path, timings):
+    # Readiness signal for launch scripts and benchmarks: exists once this instance can take work
+    if not path:
+        return
+    try:
+        with open(path, 'w') as f:
+            json.dump({'pid': os.getpid(), 'ready_at': time.time(), 'startup': timings}, f)
+    except OSError as e:
+        print(f"Could not write ready file {path}: {e}")
+
+def remove_ready_file(path):
+    if path and os.path.exists(path):
+        os.remove(path)
+
+def build_recognizer(name, data_path, index='exact', index_options=None, stub_options=None, threads=None):
+    if name == 'stub':
+        return StubRecognizer(**(stub_options or {}))
+    return FaceNetRecognizer(data_path, index, index_options, threads)
+
+def main(data_path='/home/ubuntu/data.pt', batch_size=1, index='exact', index_options=None, pipeline=False, queue_depth=20,
+         spill_bytes=None, workers=1, heartbeat_spec=None, heartbeat_interval=30, recognizer_name='facenet',
+         stub_options=None, ready_file=None):
+    global spill_threshold, recognizer, model_load_seconds
+    if spill_bytes is not None:
+        spill_threshold = spill_bytes
+
+    # Ensure the data file exists
+    if recognizer_name == 'facenet' and not os.path.exists(data_path):
+        print(f"Embedding data file {data_path} not found.")
+        return
+
+    # workers=0 means one inference process per core; split the cores between them so torch does not oversubscribe
+    cores = os.cpu_count() or 1
+    num_workers = workers or cores
+    threads_per_worker = max(1, cores // num_workers)
+
+    # Client setup and queue URL lookups overlap the model load; both finish before any worker forks
+    timings = {'imports': round(time.time() - process_started, 3)}
+    warm_up = threading.Thread(target=warm_up_clients, args=(timings,))
+    warm_up.start()
+
+    # Built before forking, so every worker shares the loaded model and gallery copy-on-write; with several
+    # workers it is built at the per-worker thread count so the supervisor never starts a full-width OpenMP pool
+    start = time.time()
+    recognizer = build_recognizer(recognizer_name, data_path, index, index_options, stub_options,
+                                  threads_per_worker if num_workers > 1 else None)
+    model_load_seconds = time.time() - start
+    timings['recognizer'] = round(model_load_seconds, 3)
+    warm_up.join()
+    timings['ready'] = round(time.time() - process_started, 3)
+    print(f"Ready {timings['ready']:.1f}s after process start ({recognizer_name} recognizer {timings['recognizer']:.1f}s, "
+          f"clients and queue URLs {timings.get('clients', float('nan')):.1f}s alongside)")
+    write_ready_file(ready_file, timings)
+
+    if num_workers > 1:
+        print(f"Starting {num_workers} inference workers with {threads_per_worker} torch threads each")
+        serve = lambda: run_worker(batch_size, pipeline, queue_depth, heartbeat_spec, heartbeat_interval)
+        run_supervisor(num_workers, serve, threads_per_worker)
+    else:
+        run_worker(batch_size, pipeline, queue_depth, heartbeat_spec, heartbeat_interval)
+    # Workers only return once the controller asked this instance to drain
+    remove_ready_file(ready_file)
+    finish_drain()
+
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description='App tier face recognition worker')
+    parser.add_argument('--data_path', type=str, default='/home/ubuntu/data.pt', help='path to the embedding data file')
+    parser.add_argument('--batch_size', type=int, default=1, help='messages pulled and inferred together (1 = one at a time)')
+    parser.add_argument('--index', type=str, default='exact', choices=['exact', 'ivf'], help='gallery search backend')
+    parser.add_argument('--nprobe', type=int, default=8, help='IVF cells scanned per query')
+    parser.add_argument('--pq_subvectors', type=int, default=None, help='store IVF vectors product-quantized with this many sub-vectors')
+    parser.add_argument('--pipeline', action='store_true', help='overlap download, inference and upload in separate stages')
+    parser.add_argument('--queue_depth', type=int, default=20, help='images buffered between pipeline stages')
+    parser.add_argument('--spill_threshold', type=int, default=spill_threshold, help='images larger than this many bytes are spooled to disk')
+    parser.add_argument('--workers', type=int, default=1, help='inference processes forked on this instance (0 = one per core)')
+    parser.add_argument('--recognizer', type=str, default='facenet', choices=['facenet', 'stub'],
+                        help='facenet runs the real models, stub answers from --stub_results without inference')
+    parser.add_argument('--stub_results', type=str,
+                        default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'faceDataset.csv'),
+                        help='CSV of Image,Results the stub recognizer answers from')
+    parser.add_argument('--stub_latency', type=float, default=0.0, help='seconds the stub recognizer sleeps per call')
+    parser.add_argument('--stub_image_latency', type=float, default=0.0, help='extra seconds the stub sleeps per image')
+    parser.add_argument('--ready_file', type=str, default='/tmp/app_tier.ready',
+                        help="written with startup timings once the worker can take requests ('' for none)")
+    parser.add_argument('--heartbeat', type=str, default='',
+                        help="where to report throughput: 'sqs:<queue>', 'file:<path>', 'cloudwatch:<namespace>' "
+                             "or '' for none (the controller passes the SQS sink with --heartbeats)")
+    parser.add_argument('--heartbeat_interval', type=float, default=30, help='seconds between heartbeats')
+    args = parser.parse_args()
+    index_options = {'nprobe': args.nprobe, 'pq_subvectors': args.pq_subvectors} if args.index == 'ivf' else None
+    stub_options = {'results_path': args.stub_results, 'latency': args.stub_latency,
+                    'image_latency': args.stub_image_latency}
+    main(args.data_path, args.batch_size, args.index, index_options, args.pipeline, args.queue_depth,
+         args.spill_threshold, args.workers, args.heartbeat, args.heartbeat_interval, args.recognizer, stub_options,
+         args.ready_file)
\ No newline at end of file
@@ -0,0 +1,69 @@
+import argparse
+import time
+import numpy as np
+from ann_index import IVFIndex
+from face_matcher import FaceMatcher
+
+parser = argparse.ArgumentParser(description='Recall vs latency of IVFIndex against the exact FaceMatcher')
+parser.add_argument('--size', type=int, default=200000, help='number of synthetic gallery embeddings')
+parser.add_argument('--dim', type=int, default=512, help='embedding dimension (InceptionResnetV1 gives 512)')
+parser.add_argument('--identities', type=int, default=20000, help='number of distinct people the embeddings cluster around')
+parser.add_argument('--noise', type=float, default=0.8, help='norm of the per-sample noise around each identity')
+parser.add_argument('--queries', type=int, default=200, help='number of queries')
+parser.add_argument('--n_lists', type=int, default=None, help='IVF cells (default sqrt(size))')
+parser.add_argument('--nprobe', type=int, nargs='+', default=[1, 4, 8, 16, 32, 64], help='cells scanned per query')
+parser.add_argument('--pq_subvectors', type=int, default=None, help='also benchmark an IVF-PQ index with this many sub-vectors')
+args = parser.parse_args()
+
+
+def normalize(x):
+    return x / np.linalg.norm(x, axis=1, keepdims=True)
+
+
+def synthetic_gallery(rng):
+    # Face embeddings cluster per person: several noisy unit vectors around each identity centre
+    centres = normalize(rng.standard_normal((args.identities, args.dim)))
+    owners = rng.integers(0, args.identities, args.size)
+    gallery = normalize(centres[owners] + args.noise * rng.standard_normal((args.size, args.dim)) / np.sqrt(args.dim))
+    # Queries are fresh noisy samples of people that are in the gallery
+    query_owners = owners[rng.integers(0, args.size, args.queries)]
+    queries = normalize(centres[query_owners] + args.noise * rng.standard_normal((args.queries, args.dim)) / np.sqrt(args.dim))
+    return gallery.astype(np.float32), owners, queries.astype(np.float32)
+
+
+def per_query_ms(fn, queries):
+    start = time.perf_counter()
+    results = [fn(query) for query in queries]
+    return (time.perf_counter() - start) * 1000 / len(queries), results
+
+
+rng = np.random.default_rng(0)
+gallery, owners, queries = synthetic_gallery(rng)
+# Every entry gets a unique name so recall can be checked by name, owners gives the person behind it
+names = [f"entry_{i}" for i in range(args.size)]
+print(f"Gallery: {args.size} x {args.dim}, {args.identities} identities, {args.queries} queries")
+
+exact = FaceMatcher(gallery, names)
+exact_ms, exact_results = per_query_ms(exact.match, queries)
+print(f"Exact FaceMatcher: {exact_ms:.3f} ms/query, {exact.gallery.nbytes / 2**20:.1f} MiB")
+
+configs = [('IVF-Flat', None)]
+if args.pq_subvectors:
+    configs.append((f'IVF-PQ{args.pq_subvectors}', args.pq_subvectors))
+
+for label, pq_subvectors in configs:
+    start = time.perf_counter()
+    index = IVFIndex(gallery, names, n_lists=args.n_lists, pq_subvectors=pq_subvectors)
+    build_s = time.perf_counter() - start
+    stored = index.codes if pq_subvectors else index.vectors
+    print(f"\n{label}: {len(index.centroids)} lists, built in {build_s:.1f}s, {stored.nbytes / 2**20:.1f} MiB of vectors")
+    print(f"{'nprobe':>8} | {'ms/query':>9} | {'speedup':>8} | {'recall@1':>9} | {'same person':>11}")
+    print("-" * 56)
+    for nprobe in args.nprobe:
+        index.nprobe = nprobe
+        ms, results = per_query_ms(index.match, queries)
+        # recall@1: same entry as exact search; same person: the answer face_match would give is unchanged
+        recall = np.mean([name == exact_name for (name, _), (exact_name, _) in zip(results, exact_results)])
+        same_person = np.mean([owners[int(name[6:])] == owners[int(exact_name[6:])]
+                               for (name, _), (exact_name, _) in zip(results, exact_results)])
+        print(f"{nprobe:>8} | {ms:9.3f} | {exact_ms / ms:7.1f}x | {recall:9.3f} | {same_person:11.3f}")
@@ -0,0 +1,55 @@
+import argparse
+import time
+import torch
+from face_matcher import FaceMatcher
+
+parser = argparse.ArgumentParser(description='Compare the per-embedding face_match loop against FaceMatcher')
+parser.add_argument('--sizes', type=int, nargs='+', default=[100, 1000, 10000, 100000], help='gallery sizes to test')
+parser.add_argument('--dim', type=int, default=512, help='embedding dimension (InceptionResnetV1 gives 512)')
+parser.add_argument('--queries', type=int, default=20, help='number of queries per gallery size')
+parser.add_argument('--loop_max_size', type=int, default=100000, help='skip the slow loop above this gallery size')
+args = parser.parse_args()
+
+
+def loop_match(emb, embedding_list, name_list):
+    # The original face_match matching step, kept verbatim for comparison
+    dist_list = []
+    for idx, emb_db in enumerate(embedding_list):
+        dist = torch.dist(emb, emb_db).item()
+        dist_list.append(dist)
+    idx_min = dist_list.index(min(dist_list))
+    return (name_list[idx_min], min(dist_list))
+
+
+def time_per_query(fn, queries):
+    start = time.perf_counter()
+    results = [fn(query) for query in queries]
+    return (time.perf_counter() - start) / len(queries), results
+
+
+torch.manual_seed(0)
+print(f"{'gallery':>10} | {'loop ms/query':>14} | {'matcher ms/query':>16} | {'build ms':>9} | {'speedup':>8}")
+print("-" * 70)
+for size in args.sizes:
+    # Same layout as data.pt: a list of (1, dim) tensors and a list of names
+    embedding_list = [torch.nn.functional.normalize(torch.randn(1, args.dim), dim=1) for _ in range(size)]
+    name_list = [f"person_{i}" for i in range(size)]
+    queries = [torch.nn.functional.normalize(torch.randn(1, args.dim), dim=1) for _ in range(args.queries)]
+
+    start = time.perf_counter()
+    matcher = FaceMatcher(embedding_list, name_list)
+    build_ms = (time.perf_counter() - start) * 1000
+
+    matcher_s, matcher_results = time_per_query(matcher.match, queries)
+
+    if size <= args.loop_max_size:
+        loop_s, loop_results = time_per_query(lambda q: loop_match(q, embedding_list, name_list), queries)
+        for (loop_name, loop_dist), (name, dist) in zip(loop_results, matcher_results):
+            assert loop_name == name and abs(loop_dist - dist) < 1e-4, f"Mismatch: {loop_name} vs {name}"
+        loop_col = f"{loop_s * 1000:14.3f}"
+        speedup_col = f"{loop_s / matcher_s:7.1f}x"
+    else:
+        loop_col = f"{'skipped':>14}"
+        speedup_col = f"{'-':>8}"
+
+    print(f"{size:>10} | {loop_col} | {matcher_s * 1000:16.3f} | {build_ms:9.1f} | {speedup_col}")
@@ -0,0 +1,128 @@
+import argparse
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+import requests
+from concurrent.futures import ThreadPoolExecutor
+from local_aws import local_client
+
+parser = argparse.ArgumentParser(description='End-to-end throughput of web_tier.py + app_tier.py on this machine, '
+                                             'with local_aws.py standing in for SQS and S3')
+parser.add_argument('--image_folder', type=str, required=True, help='folder of test images to upload')
+parser.add_argument('--data_path', type=str, default='data.pt', help='embedding data file for the app tier')
+parser.add_argument('--workers', type=int, nargs='+', default=[1, 2], help='app-tier worker process counts to test')
+parser.add_argument('--batch_sizes', type=int, nargs='+', default=[1, 4], help='app-tier batch sizes to test')
+parser.add_argument('--app_args', type=str, nargs=argparse.REMAINDER, default=[],
+                    help='extra app_tier.py arguments for every run, e.g. --app_args --recognizer stub '
+                         '--stub_latency 0.05 to measure the orchestration path without inference')
+parser.add_argument('--requests', type=int, default=100, help='requests per configuration')
+parser.add_argument('--concurrency', type=int, default=20, help='requests in flight at once')
+parser.add_argument('--port', type=int, default=8000, help='port for the web tier')
+parser.add_argument('--root', type=str, default=None, help='directory for the local queues and buckets (temp dir if omitted)')
+parser.add_argument('--startup_timeout', type=float, default=300, help='seconds to wait for the tiers to come up')
+args = parser.parse_args()
+
+ASU_ID = '1231674381'
+here = os.path.dirname(os.path.abspath(__file__))
+url = f'http://127.0.0.1:{args.port}/'
+
+
+def percentile(values, q):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * q))] if ordered else float('nan')
+
+
+def start_tiers(root, workers, batch_size):
+    # Queues must exist before the tiers resolve their URLs during their startup warm-up
+    sqs = local_client('sqs', root)
+    for name in ('req-queue', 'resp-queue'):
+        sqs.create_queue(QueueName=f'{ASU_ID}-{name}')
+    env = {**os.environ, 'CSE546_LOCAL_AWS': root}
+    app_log = open(os.path.join(root, 'app_tier.log'), 'w')
+    web_log = open(os.path.join(root, 'web_tier.log'), 'w')
+    app = subprocess.Popen([sys.executable, 'app_tier.py', '--data_path', os.path.abspath(args.data_path),
+                            '--workers', str(workers), '--batch_size', str(batch_size),
+                            '--ready_file', os.path.join(root, 'app_tier.ready'),
+                            *args.app_args], cwd=here, env=env, stdout=app_log, stderr=subprocess.STDOUT)
+    web = subprocess.Popen([sys.executable, '-m', 'uvicorn', 'web_tier:app', '--port', str(args.port),
+                            '--log-level', 'warning'], cwd=here, env=env, stdout=web_log, stderr=subprocess.STDOUT)
+    return [app, web]
+
+
+def stop_tiers(processes):
+    for process in processes:
+        if process.poll() is None:
+            process.send_signal(signal.SIGTERM)
+    for process in processes:
+        try:
+            process.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+
+def send(image_path, number):
+    # A unique trailer per request keeps the web tier's result cache and request coalescing out of the measurement
+    with open(image_path, 'rb') as f:
+        data = f.read() + f"\n{number}".encode()
+    start = time.perf_counter()
+    try:
+        # Keep the file name, the stub recognizer answers by it
+        response = requests.post(url, files={'inputFile': (os.path.basename(image_path), data)}, timeout=600)
+        ok = response.status_code == 200
+    except requests.exceptions.RequestException:
+        ok = False
+    return ok, time.perf_counter() - start
+
+
+def tiers_ready(root):
+    try:
+        web_ready = requests.get(url + 'ready', timeout=1).status_code == 200
+    except requests.exceptions.RequestException:
+        web_ready = False
+    return web_ready and os.path.exists(os.path.join(root, 'app_tier.ready'))
+
+
+def wait_until_ready(root, images, processes):
+    # Both tiers signal readiness (GET /ready and the app tier's ready file), then one request warms the path
+    start = time.time()
+    while time.time() - start < args.startup_timeout:
+        if any(process.poll() is not None for process in processes):
+            raise RuntimeError("A tier exited during startup, see its log in the run directory")
+        if tiers_ready(root):
+            print(f"Tiers ready after {time.time() - start:.2f}s")
+            if send(images[0], 'warmup')[0]:
+                return
+        time.sleep(0.1)
+    raise RuntimeError(f"Tiers not ready after {args.startup_timeout}s")
+
+
+def run(root, images, workers, batch_size):
+    processes = start_tiers(root, workers, batch_size)
+    try:
+        wait_until_ready(root, images, processes)
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+            results = list(executor.map(lambda i: send(images[i % len(images)], i), range(args.requests)))
+        elapsed = time.perf_counter() - start
+    finally:
+        stop_tiers(processes)
+    latencies = [latency for ok, latency in results if ok]
+    return {'ok': len(latencies), 'failed': len(results) - len(latencies), 'rps': len(latencies) / elapsed,
+            'p50': percentile(latencies, 0.5), 'p95': percentile(latencies, 0.95), 'p99': percentile(latencies, 0.99)}
+
+
+images = sorted(os.path.join(args.image_folder, name) for name in os.listdir(args.image_folder))
+root = args.root or tempfile.mkdtemp(prefix='pipeline-bench-')
+print(f"{len(images)} images, {args.requests} requests per run at concurrency {args.concurrency}, state under {root}")
+print(f"{'workers':>7} | {'batch':>5} | {'ok':>5} | {'failed':>6} | {'req/s':>7} | {'p50 s':>7} | {'p95 s':>7} | {'p99 s':>7}")
+print("-" * 70)
+for workers in args.workers:
+    for batch_size in args.batch_sizes:
+        run_root = os.path.join(root, f'workers{workers}-batch{batch_size}')
+        os.makedirs(run_root, exist_ok=True)
+        r = run(run_root, images, workers, batch_size)
+        print(f"{workers:7d} | {batch_size:5d} | {r['ok']:5d} | {r['failed']:6d} | {r['rps']:7.2f} | "
+              f"{r['p50']:7.3f} | {r['p95']:7.3f} | {r['p99']:7.3f}")
@@ -1,81 +1,371 @@
 # controller.py
 
-import boto3
+import argparse
+import asyncio
+import json
 import time
 import os
+from collections import deque
+from clients import LazyClient, LazyResource, queue_url
+from scaling_policy import POLICIES, QueueSample, build_autoscaler
+from inventory import InstanceInventory
+from telemetry import WorkerMonitor
+from warm_pool import ScaleOutTracker, WarmPool, instance_tags
 
-# Initialize AWS services clients
-sqs = boto3.client('sqs', region_name='us-east-1')
-ec2 = boto3.resource('ec2', region_name='us-east-1')
+# AWS clients, created on first use so importing the controller never builds one
+sqs = LazyClient('sqs', 'us-east-1')
+ec2 = LazyResource('ec2', 'us-east-1')
+ec2_client = LazyClient('ec2', 'us-east-1')
 
 # Constants for queue and bucket names
 ASU_ID = '1231674381'
 REGION = 'us-east-1'
-request_queue_url = sqs.get_queue_url(QueueName=f'{ASU_ID}-req-queue')['QueueUrl']
-response_queue_url = sqs.get_queue_url(QueueName=f'{ASU_ID}-resp-queue')['QueueUrl']
+# Resolved on first use and cached on disk (see clients.queue_url); the controller never reads responses
+request_queue = f'{ASU_ID}-req-queue'
 input_bucket = f'{ASU_ID}-in-bucket'
 app_tier_ami_id = 'ami-0eff13949d9e2cd6c'
 
+# Launch settings shared by cold launches and warm-pool instances
+app_tier_launch_kwargs = {
+    'ImageId': app_tier_ami_id,
+    'InstanceType': 't2.micro',
+    'KeyName': 'Sachin_Bellamkonda',
+    'IamInstanceProfile': {'Name': 'AppTierRole'},
+    # Workers read their AppTierDrain tag from instance metadata, without an EC2 API call
+    'MetadataOptions': {'HttpEndpoint': 'enabled', 'InstanceMetadataTags': 'enabled'},
+}
+
+# Workers asked to drain get a little while to finish their current batch before they are terminated anyway
+drain_timeout = 120
+
+# Locally tracked app-tier instances, only re-described from EC2 every reconcile interval
+inventory = InstanceInventory(ec2)
+
+# Optional pool of stopped, pre-initialized instances (see --warm_pool) and scale-out latency tracking
+warm_pool = None
+scale_outs = ScaleOutTracker()
+
+# Worker heartbeats (see --heartbeats and app_tier.py --heartbeat); the queue URL is only set when enabled
+heartbeat_queue_url = None
+# Extra app_tier.py arguments for launched instances, e.g. to turn their heartbeats on
+app_tier_args = ''
+worker_monitor = WorkerMonitor()
+
 def get_queue_length():
     """Retrieve the number of messages in the request queue."""
+    return get_queue_stats()[0]
+
+def get_queue_stats():
+    """Retrieve the visible and in-flight (received, not yet deleted) message counts of the request queue."""
     attributes = sqs.get_queue_attributes(
-        QueueUrl=request_queue_url,
-        AttributeNames=['ApproximateNumberOfMessages']
+        QueueUrl=queue_url(request_queue, REGION),
+        AttributeNames=['ApproximateNumberOfMessages', 'ApproximateNumberOfMessagesNotVisible']
+    )['Attributes']
+    return (int(attributes.get('ApproximateNumberOfMessages', '0')),
+            int(attributes.get('ApproximateNumberOfMessagesNotVisible', '0')))
+
+def get_app_tier_instances():
+    if not inventory.refresh_if_due():
+        # Tags workers set on themselves (AppTierDrain=drained, FirstMessageAt) only show up in a describe, so
+        # the few instances waiting on one are described every tick instead of once per reconcile interval
+        watched = [inst.id for inst in inventory.query('true', ['running', 'pending'])
+                   if drain_state(inst) is not None or inst.id in scale_outs.started]
+        try:
+            inventory.refresh(watched)
+        except Exception as e:
+            print(f"Could not refresh {len(watched)} draining or new instances, using the last known tags: {e}")
+    return inventory.query('true', ['running', 'pending'])
+
+# Tag and state changes go through the client with explicit ids (collection actions would describe first)
+# and are mirrored into the inventory straight away
+def tag_instances(instance_ids, tags):
+    ec2_client.create_tags(Resources=instance_ids, Tags=tags)
+    inventory.record_tags(instance_ids, tags)
+
+def untag_instances(instance_ids, keys):
+    ec2_client.delete_tags(Resources=instance_ids, Tags=[{'Key': key} for key in keys])
+    inventory.record_deleted_tags(instance_ids, keys)
+
+def drain_state(instance):
+    """'requested' or 'drained' while an instance is being scaled in, None for an active worker."""
+    return instance_tags(instance).get('AppTierDrain')
+
+def retire_instances(instances):
+    """Stop instances back into the warm pool while it has room, terminate the rest."""
+    if not instances:
+        return
+    # Pooled instances must come back as active workers when they are started again
+    untag_instances([inst.id for inst in instances], ['AppTierDrain', 'DrainRequestedAt'])
+    if warm_pool is not None:
+        room = warm_pool.pool_size - len(warm_pool.pooled_instances())
+        stopped = warm_pool.stop(instances[:max(0, room)])
+        instances = instances[len(stopped):]
+    instances_to_terminate = [inst.id for inst in instances]
+    if instances_to_terminate:
+        ec2_client.terminate_instances(InstanceIds=instances_to_terminate)
+        inventory.record_state(instances_to_terminate, 'terminated')
+        print(f"Terminated {len(instances_to_terminate)} App Tier instances.")
+
+def replace_stalled_instances(stalled_instances):
+    """Terminate workers that stopped reporting or stopped making progress, scale-out launches replacements."""
+    # A hung worker is not worth keeping in the warm pool, so these are always terminated
+    ids = [inst.id for inst in stalled_instances]
+    ec2_client.terminate_instances(InstanceIds=ids)
+    inventory.record_state(ids, 'terminated')
+    print(f"Terminated {len(ids)} stalled App Tier instances: {ids}")
+
+def retire_drained_instances(draining_instances):
+    """Retire workers that finished draining, or that did not manage to within drain_timeout."""
+    now = time.time()
+    done = []
+    for inst in draining_instances:
+        tags = instance_tags(inst)
+        requested_at = float(tags.get('DrainRequestedAt', now))
+        if tags.get('AppTierDrain') == 'drained':
+            done.append(inst)
+        elif now - requested_at > drain_timeout:
+            print(f"Instance {inst.id} did not drain within {drain_timeout}s, retiring it anyway.")
+            done.append(inst)
+    retire_instances(done)
+
+def launch_app_tier_instances(count, first_number):
+    """Launch count new app-tier instances with one create_instances call."""
+    launched = ec2.create_instances(
+        MinCount=1,
+        MaxCount=count,
+        TagSpecifications=[{
+            'ResourceType': 'instance',
+            'Tags': [
+                {'Key': 'Name', 'Value': 'app-tier-instance'},
+                {'Key': 'AppTier', 'Value': 'true'}
+            ]
+        }],
+        # Also start app_tier.py on every reboot, so the instance can be stopped into the warm pool
+        UserData=f"""#!/bin/bash
+        cd /home/ubuntu/
+        (crontab -l -u ubuntu 2>/dev/null; echo "@reboot cd /home/ubuntu && /home/ubuntu/ccp2/bin/python3 /home/ubuntu/app_tier.py {app_tier_args} > app_tier.log 2>&1") | crontab -u ubuntu -
+        source /home/ubuntu/ccp2/bin/activate
+        nohup python3 /home/ubuntu/app_tier.py {app_tier_args} > app_tier.log 2>&1 &
+        """,
+        **app_tier_launch_kwargs
     )
-    return int(attributes['Attributes'].get('ApproximateNumberOfMessages', '0'))
-
-def adjust_app_tier_instances(queue_length):
-    """Scale up or down the app tier based on the queue length."""
-    # Define scaling thresholds and logic
-    desired_instance_count = min(20,queue_length)
-    if queue_length==0 and desired_instance_count>0:
-        desired_instance_count=0
-    current_instances = list(ec2.instances.filter(
-        Filters=[
-            {'Name': 'tag:AppTier', 'Values': ['true']},
-            {'Name': 'instance-state-name', 'Values': ['running', 'pending']}
-        ]
-    ))
-    current_count = len(current_instances)
+    inventory.record_launch([inst.id for inst in launched], [{'Key': 'AppTier', 'Value': 'true'}])
+    # Number the instances like before, the tags in one launch call have to be identical
+    for i, inst in enumerate(launched):
+        tag_instances([inst.id], [{'Key': 'Name', 'Value': f'app-tier-instance-{first_number + i}'}])
+    scale_outs.record_start([inst.id for inst in launched], 'cold')
+    print(f"Launched {len(launched)} App Tier instances: {[inst.id for inst in launched]}")
+    return launched
+
+def adjust_app_tier_instances(desired_instance_count, current_instances):
+    """Scale the app tier up or down to desired_instance_count."""
+    active_instances = [inst for inst in current_instances if drain_state(inst) is None]
+    draining_instances = [inst for inst in current_instances if drain_state(inst) is not None]
+    current_count = len(active_instances)
 
     if current_count < desired_instance_count:
-        # Launch new instances
         instances_needed = desired_instance_count - current_count
-        for i in range(instances_needed):
-            instance_number = current_count + i + 1
-            ec2.create_instances(
-                ImageId=app_tier_ami_id,
-                MinCount=1,
-                MaxCount=1,
-                InstanceType='t2.micro',
-                KeyName='Sachin_Bellamkonda',
-                IamInstanceProfile={'Name': 'AppTierRole'},
-                TagSpecifications=[{
-                    'ResourceType': 'instance',
-                    'Tags': [
-                        {'Key': 'Name', 'Value': f'app-tier-instance-{instance_number}'},
-                        {'Key': 'AppTier', 'Value': 'true'}
-                    ]
-                }],
-                UserData="""#!/bin/bash
-                cd /home/ubuntu/
-                source /home/ubuntu/ccp2/bin/activate
-                nohup python3 /home/ubuntu/app_tier.py > app_tier.log 2>&1 &
-                """
-            )
-            print(f"Launched app-tier-instance-{instance_number}.")
+        # Draining instances are not reused: a worker that has seen its drain tag exits whatever the tag says
+        # afterwards, so the capacity comes from the warm pool or new launches.
+        # Start stopped warm-pool instances first, they skip launch and first-boot setup
+        if warm_pool is not None and instances_needed > 0:
+            started = warm_pool.start(instances_needed, current_count + 1)
+            scale_outs.record_start(started, 'warm')
+            current_count += len(started)
+            instances_needed -= len(started)
+        # Launch the rest in one call
+        if instances_needed > 0:
+            launch_app_tier_instances(instances_needed, current_count + 1)
     elif current_count > desired_instance_count:
-        # Terminate excess instances
-        instances_to_terminate = [inst.id for inst in current_instances[desired_instance_count:]]
-        ec2.instances.filter(InstanceIds=instances_to_terminate).terminate()
-        print(f"Terminated {len(instances_to_terminate)} excess App Tier instances.")
+        # Ask the excess workers to finish their current batch and exit; they are retired once they have
+        excess_instances = active_instances[desired_instance_count:]
+        tag_instances([inst.id for inst in excess_instances], [
+            {'Key': 'AppTierDrain', 'Value': 'requested'},
+            {'Key': 'DrainRequestedAt', 'Value': f"{time.time():.0f}"}
+        ])
+        print(f"Asked {len(excess_instances)} excess App Tier instances to drain.")
+
+    retire_drained_instances(draining_instances)
+
+    if warm_pool is not None:
+        warm_pool.promote_warmed()
+        warm_pool.replenish()
+
+# Latest decision and timings, served as JSON on the metrics endpoint
+controller_metrics = {'ticks': 0, 'spike_ticks': 0, 'stalled_replaced': 0, 'last_tick': None,
+                      'decisions': deque(maxlen=50)}
+
+async def timed(name, fn, timings):
+    # Run a blocking boto3 call on the default executor and record how long it took
+    start = time.time()
+    result = await asyncio.get_running_loop().run_in_executor(None, fn)
+    timings[name] = round(time.time() - start, 4)
+    return result
+
+def receive_heartbeats(max_messages=100):
+    """Feed queued worker heartbeats into worker_monitor, returns how many were read."""
+    received = 0
+    while received < max_messages:
+        messages = sqs.receive_message(QueueUrl=heartbeat_queue_url, MaxNumberOfMessages=10,
+                                       WaitTimeSeconds=0).get('Messages', [])
+        if not messages:
+            break
+        for message in messages:
+            try:
+                worker_monitor.ingest(json.loads(message['Body']))
+            except (ValueError, KeyError) as e:
+                print(f"Ignoring malformed heartbeat: {e}")
+        sqs.delete_message_batch(QueueUrl=heartbeat_queue_url, Entries=[
+            {'Id': str(i), 'ReceiptHandle': message['ReceiptHandle']} for i, message in enumerate(messages)])
+        received += len(messages)
+    return received
+
+def apply_measured_throughput(autoscaler, throughput):
+    # Size the tier from what workers actually process instead of the --throughput guess
+    autoscaler.tracker.per_instance_throughput = throughput
+    if hasattr(autoscaler.policy, 'per_instance_throughput'):
+        autoscaler.policy.per_instance_throughput = throughput
 
-def autoscale_app_tier():
-    """Background thread function to autoscale the app tier."""
+async def collect_metrics():
+    """Fetch queue attributes, the instance inventory and worker heartbeats concurrently."""
+    timings = {}
+    collectors = [timed('queue', get_queue_stats, timings), timed('instances', get_app_tier_instances, timings)]
+    if heartbeat_queue_url is not None:
+        collectors.append(timed('heartbeats', receive_heartbeats, timings))
+    (visible, in_flight), current_instances, *_ = await asyncio.gather(*collectors)
+    return visible, in_flight, current_instances, timings
+
+async def watch_queue_depth(wake, watch_interval, spike_threshold):
+    # Cheap single-attribute poll between ticks, waking the controller early when the backlog jumps
+    last_visible = None
     while True:
-        queue_length = get_queue_length()
-        adjust_app_tier_instances(queue_length)
-        time.sleep(15)
+        await asyncio.sleep(watch_interval)
+        try:
+            visible = await asyncio.get_running_loop().run_in_executor(None, get_queue_length)
+        except Exception as e:
+            print(f"Queue depth watch failed: {e}")
+            continue
+        if last_visible is not None and visible - last_visible >= spike_threshold:
+            print(f"Queue depth spiked from {last_visible} to {visible}, ticking early")
+            wake.set()
+        last_visible = visible
+
+async def serve_metrics(reader, writer):
+    # Minimal HTTP/1.0 responder, every path returns the controller metrics as JSON
+    try:
+        while (await reader.readline()).strip():
+            pass
+        body = json.dumps({**controller_metrics, 'decisions': list(controller_metrics['decisions']),
+                           'ec2_describe_calls': inventory.describe_calls,
+                           'time_to_first_message': scale_outs.summary(),
+                           'workers': worker_monitor.summary(time.time())}).encode()
+        writer.write(b"HTTP/1.0 200 OK\r\nContent-Type: application/json\r\n"
+                     + f"Content-Length: {len(body)}\r\n\r\n".encode() + body)
+        await writer.drain()
+    finally:
+        writer.close()
+
+async def autoscale_app_tier(autoscaler, interval=15, record_trace=None, watch_interval=3, spike_threshold=10,
+                             metrics_port=9100):
+    """Controller loop: tick every interval seconds, or early when the queue depth spikes."""
+    if record_trace and not os.path.exists(record_trace):
+        with open(record_trace, 'w') as f:
+            f.write("timestamp,visible,in_flight,instances\n")
+    loop = asyncio.get_running_loop()
+    wake = asyncio.Event()
+    watcher = asyncio.create_task(watch_queue_depth(wake, watch_interval, spike_threshold))
+    server = await asyncio.start_server(serve_metrics, '127.0.0.1', metrics_port)
+    print(f"Controller metrics on http://127.0.0.1:{metrics_port}/")
+
+    try:
+        while True:
+            trigger = 'spike' if wake.is_set() else 'periodic'
+            wake.clear()
+            tick_start = time.time()
+            visible, in_flight, current_instances, timings = await collect_metrics()
+            if heartbeat_queue_url is not None:
+                active_ids = [inst.id for inst in current_instances if drain_state(inst) is None]
+                stalled_ids = worker_monitor.update(active_ids, visible, time.time())
+                if stalled_ids:
+                    stalled = [inst for inst in current_instances if inst.id in stalled_ids]
+                    await loop.run_in_executor(None, replace_stalled_instances, stalled)
+                    current_instances = [inst for inst in current_instances if inst.id not in stalled_ids]
+                    controller_metrics['stalled_replaced'] += len(stalled)
+                if worker_monitor.throughput:
+                    apply_measured_throughput(autoscaler, worker_monitor.throughput)
+            active_count = sum(1 for inst in current_instances if drain_state(inst) is None)
+            sample = QueueSample(time.time(), visible, in_flight, active_count)
+            desired_instance_count = autoscaler.decide(sample)
+            scale_outs.collect(current_instances)
+            print(f"Queue {visible} visible / {in_flight} in flight, arrival {autoscaler.tracker.arrival_rate:.2f}/s, "
+                  f"drain {autoscaler.tracker.drain_rate:.2f}/s, instances {active_count} -> {desired_instance_count} "
+                  f"({trigger}, {inventory.describe_calls} EC2 describe calls so far)")
+            if record_trace:
+                # Replay with simulate_scaling.py --trace to compare policies offline
+                with open(record_trace, 'a') as f:
+                    f.write(f"{sample.timestamp:.3f},{visible},{in_flight},{active_count}\n")
+
+            start = time.time()
+            await loop.run_in_executor(None, adjust_app_tier_instances, desired_instance_count, current_instances)
+            timings['adjust'] = round(time.time() - start, 4)
+            timings['tick'] = round(time.time() - tick_start, 4)
+            if scale_outs.latencies['warm'] or scale_outs.latencies['cold']:
+                print(f"Time to first message per scale-out: {scale_outs.summary()}")
+
+            tick = {'timestamp': sample.timestamp, 'trigger': trigger, 'visible': visible, 'in_flight': in_flight,
+                    'active_instances': active_count, 'desired_instances': desired_instance_count,
+                    'arrival_rate': round(autoscaler.tracker.arrival_rate, 3),
+                    'drain_rate': round(autoscaler.tracker.drain_rate, 3),
+                    'per_instance_throughput': round(autoscaler.tracker.per_instance_throughput, 3), 'timings': timings}
+            controller_metrics['ticks'] += 1
+            controller_metrics['spike_ticks'] += trigger == 'spike'
+            controller_metrics['last_tick'] = tick
+            if desired_instance_count != active_count:
+                controller_metrics['decisions'].append(tick)
+
+            try:
+                await asyncio.wait_for(wake.wait(), timeout=interval)
+            except asyncio.TimeoutError:
+                pass
+    finally:
+        watcher.cancel()
+        server.close()
 
 if __name__ == "__main__":
-    autoscale_app_tier()
+    parser = argparse.ArgumentParser(description='App tier autoscaling controller')
+    parser.add_argument('--policy', type=str, default='queue_length', choices=sorted(POLICIES), help='scaling policy')
+    parser.add_argument('--max_instances', type=int, default=20, help='app-tier instance limit')
+    parser.add_argument('--throughput', type=float, default=1.0, help='images/sec one app-tier instance processes')
+    parser.add_argument('--boot_time', type=float, default=60.0, help='seconds from launch until an instance takes work')
+    parser.add_argument('--scale_down_delay', type=float, default=60.0, help='seconds a lower target must hold before scale-in')
+    parser.add_argument('--scale_up_cooldown', type=float, default=0.0, help='minimum seconds between two scale-outs')
+    parser.add_argument('--target_drain_seconds', type=float, default=60.0,
+                        help='seconds the predictive policy aims to clear the projected backlog in')
+    parser.add_argument('--interval', type=float, default=15, help='seconds between controller ticks')
+    parser.add_argument('--warm_pool', type=int, default=0, help='stopped, pre-initialized instances to keep ready (0 = off)')
+    parser.add_argument('--drain_timeout', type=float, default=120, help='seconds a worker gets to drain before it is retired anyway')
+    parser.add_argument('--reconcile_interval', type=float, default=60, help='seconds between full EC2 describes of the tier')
+    parser.add_argument('--watch_interval', type=float, default=3, help='seconds between queue-depth checks between ticks')
+    parser.add_argument('--spike_threshold', type=int, default=10, help='queue growth between checks that triggers an early tick')
+    parser.add_argument('--metrics_port', type=int, default=9100, help='local port serving controller decisions and timings')
+    parser.add_argument('--heartbeats', action='store_true',
+                        help='consume app-tier heartbeats: learn per-instance throughput and replace stalled workers')
+    parser.add_argument('--stall_timeout', type=float, default=300,
+                        help='seconds without a heartbeat, or without progress while requests wait, before a worker is replaced')
+    parser.add_argument('--record_trace', type=str, default=None, help='append every queue sample to this CSV')
+    args = parser.parse_args()
+    autoscaler = build_autoscaler(args.policy, args.max_instances, args.throughput, args.boot_time,
+                                  target_drain_seconds=args.target_drain_seconds, scale_up_cooldown=args.scale_up_cooldown,
+                                  scale_down_delay=args.scale_down_delay)
+    drain_timeout = args.drain_timeout
+    inventory.reconcile_interval = args.reconcile_interval
+    if args.heartbeats:
+        # Heartbeats older than a few minutes say nothing about the tier any more
+        heartbeat_queue_url = sqs.create_queue(QueueName=f'{ASU_ID}-heartbeat-queue',
+                                               Attributes={'MessageRetentionPeriod': '300'})['QueueUrl']
+        worker_monitor.stall_timeout = args.stall_timeout
+        app_tier_args = f'--heartbeat sqs:{ASU_ID}-heartbeat-queue'
+    if args.warm_pool:
+        warm_pool = WarmPool(ec2, args.warm_pool, app_tier_launch_kwargs, inventory, app_tier_args)
+    asyncio.run(autoscale_app_tier(autoscaler, args.interval, args.record_trace, args.watch_interval,
+                                   args.spike_threshold, args.metrics_port))
@@ -4,6 +4,7 @@ import sys
 import torch
 from PIL import Image
 from facenet_pytorch import MTCNN, InceptionResnetV1
+from gallery_store import get_gallery_store
 from torchvision import datasets
 from torch.utils.data import DataLoader
 
@@ -17,17 +18,8 @@ def face_match(img_path, data_path): # img_path= location of photo, data_path= l
     face, prob = mtcnn(img, return_prob=True) # returns cropped face and probability
     emb = resnet(face.unsqueeze(0)).detach()
 
-    saved_data = torch.load('data.pt') # loading data.pt file
-    embedding_list = saved_data[0] # getting embedding data
-    name_list = saved_data[1] # getting list of names
-    dist_list = [] # list of matched distances, minimum distance is used to identify the person
-
-    for idx, emb_db in enumerate(embedding_list):
-        dist = torch.dist(emb, emb_db).item()
-        dist_list.append(dist)
-
-    idx_min = dist_list.index(min(dist_list))
-    return (name_list[idx_min], min(dist_list))
+    matcher = get_gallery_store(data_path).get() # data.pt is loaded once per process
+    return matcher.match(emb) # single batched distance + argmin
 
 result = face_match(test_image, 'data.pt')
 print(result[0])
\ No newline at end of file
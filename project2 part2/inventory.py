@@ -0,0 +1,106 @@
+import time
+
+
+class InventoryInstance:
+    """What the controller knows about one app-tier instance: id, state and tags (boto3 tag list format)."""
+
+    def __init__(self, instance_id, state, tags):
+        self.id = instance_id
+        self.state = state
+        self.tags = tags
+
+    def set_tags(self, tags):
+        keys = {tag['Key'] for tag in tags}
+        self.tags = [tag for tag in self.tags if tag['Key'] not in keys] + list(tags)
+
+    def delete_tags(self, keys):
+        self.tags = [tag for tag in self.tags if tag['Key'] not in keys]
+
+
+class InstanceInventory:
+    """Local view of the app-tier instances, reconciled with EC2 every reconcile_interval seconds.
+
+    The controller records its own launches, starts, stops, terminations and
+    tag changes here as it makes them, so a tick normally needs no describe
+    call at all. Changes made outside the controller (boot finishing,
+    instances stopping themselves, workers tagging themselves) are picked up
+    at the next reconcile, or sooner for the instances passed to refresh().
+    """
+
+    # Tag values under AppTier that belong to the tier, and the states worth tracking
+    tier_tags = ['true', 'warming']
+    tracked_states = ['pending', 'running', 'stopping', 'stopped']
+
+    def __init__(self, ec2, reconcile_interval=60):
+        self.ec2 = ec2
+        self.reconcile_interval = reconcile_interval
+        self.instances = {}
+        self.reconciled_at = float('-inf')
+        self.describe_calls = 0
+
+    def reconcile(self):
+        """Replace the local view with one paginated describe_instances over the whole tier."""
+        paginator = self.ec2.meta.client.get_paginator('describe_instances')
+        instances = {}
+        for page in paginator.paginate(Filters=[
+            {'Name': 'tag:AppTier', 'Values': self.tier_tags},
+            {'Name': 'instance-state-name', 'Values': self.tracked_states}
+        ]):
+            self.describe_calls += 1
+            for reservation in page['Reservations']:
+                for inst in reservation['Instances']:
+                    instances[inst['InstanceId']] = InventoryInstance(inst['InstanceId'], inst['State']['Name'],
+                                                                      inst.get('Tags', []))
+        self.instances = instances
+        self.reconciled_at = time.time()
+
+    def refresh_if_due(self, force=False):
+        """Reconcile if the interval has passed, returns whether it did."""
+        if force or time.time() - self.reconciled_at >= self.reconcile_interval:
+            self.reconcile()
+            return True
+        return False
+
+    def refresh(self, instance_ids):
+        """Re-describe just instance_ids, for tags or states expected to change before the next reconcile."""
+        if not instance_ids:
+            return
+        paginator = self.ec2.meta.client.get_paginator('describe_instances')
+        seen = set()
+        for page in paginator.paginate(InstanceIds=list(instance_ids)):
+            self.describe_calls += 1
+            for reservation in page['Reservations']:
+                for inst in reservation['Instances']:
+                    if inst['State']['Name'] in self.tracked_states:
+                        seen.add(inst['InstanceId'])
+                        self.instances[inst['InstanceId']] = InventoryInstance(
+                            inst['InstanceId'], inst['State']['Name'], inst.get('Tags', []))
+        for instance_id in set(instance_ids) - seen:
+            self.instances.pop(instance_id, None)
+
+    def query(self, app_tier, states):
+        """Instances tagged AppTier=app_tier in one of states."""
+        return [inst for inst in self.instances.values()
+                if inst.state in states and {tag['Key']: tag['Value'] for tag in inst.tags}.get('AppTier') == app_tier]
+
+    def record_launch(self, instance_ids, tags):
+        for instance_id in instance_ids:
+            self.instances[instance_id] = InventoryInstance(instance_id, 'pending', list(tags))
+
+    def record_state(self, instance_ids, state):
+        for instance_id in instance_ids:
+            if state in self.tracked_states:
+                if instance_id in self.instances:
+                    self.instances[instance_id].state = state
+            else:
+                self.instances.pop(instance_id, None)  # terminated instances leave the tier
+
+    def record_tags(self, instance_ids, tags):
+        for instance_id in instance_ids:
+            if instance_id in self.instances:
+                self.instances[instance_id].set_tags(tags)
+
+    def record_deleted_tags(self, instance_ids, keys):
+        for instance_id in instance_ids:
+            if instance_id in self.instances:
+                self.instances[instance_id].delete_tags(keys)
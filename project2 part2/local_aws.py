@@ -0,0 +1,347 @@
+import hashlib
+import io
+import os
+import pickle
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+import uuid
+
+# Stand-ins for the subset of the SQS and S3 client calls the web and app tiers make, so the whole
+# pipeline can run on one box. Queues live in one SQLite file and objects in a directory tree, so
+# separate processes (uvicorn, forked app-tier workers, the benchmark) all see the same state.
+
+
+class QueueDoesNotExist(Exception):
+    pass
+
+
+class ReceiptHandleIsInvalid(Exception):
+    pass
+
+
+class NoSuchKey(Exception):
+    pass
+
+
+class NoSuchUpload(Exception):
+    pass
+
+
+class LocalSQSExceptions:
+    QueueDoesNotExist = QueueDoesNotExist
+    ReceiptHandleIsInvalid = ReceiptHandleIsInvalid
+
+
+class LocalS3Exceptions:
+    NoSuchKey = NoSuchKey
+    NoSuchUpload = NoSuchUpload
+
+
+def queue_name(queue_url):
+    return queue_url.rsplit('/', 1)[-1]
+
+
+class LocalSQS:
+    """SQS queues in a SQLite database: visibility timeouts, long polling, batches and message attributes.
+
+    Each thread (and each forked process) gets its own connection; receives
+    claim messages inside an immediate transaction so two consumers never
+    get the same message. Ordering is best-effort FIFO, like a standard queue.
+    """
+
+    exceptions = LocalSQSExceptions
+    poll_interval = 0.05
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.local = threading.local()
+        with self._transaction() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS queues (name TEXT PRIMARY KEY, visibility_timeout REAL)")
+            conn.execute("CREATE TABLE IF NOT EXISTS messages (seq INTEGER PRIMARY KEY AUTOINCREMENT, queue TEXT, "
+                         "message_id TEXT, body TEXT, attributes BLOB, visible_at REAL, receipt TEXT)")
+            conn.execute("CREATE INDEX IF NOT EXISTS messages_visible ON messages (queue, visible_at)")
+
+    def _connection(self):
+        # Connections must not cross threads or a fork
+        if getattr(self.local, 'pid', None) != os.getpid():
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self.local.conn, self.local.pid = conn, os.getpid()
+        return self.local.conn
+
+    class _Transaction:
+        def __init__(self, conn):
+            self.conn = conn
+
+        def __enter__(self):
+            self.conn.execute("BEGIN IMMEDIATE")
+            return self.conn
+
+        def __exit__(self, exc_type, exc, tb):
+            self.conn.execute("ROLLBACK" if exc_type else "COMMIT")
+
+    def _transaction(self):
+        return self._Transaction(self._connection())
+
+    def _queue(self, conn, queue_url):
+        name = queue_name(queue_url)
+        row = conn.execute("SELECT visibility_timeout FROM queues WHERE name = ?", (name,)).fetchone()
+        if row is None:
+            raise QueueDoesNotExist(name)
+        return name, row[0]
+
+    def create_queue(self, QueueName, Attributes=None):
+        visibility_timeout = float((Attributes or {}).get('VisibilityTimeout', 30))
+        with self._transaction() as conn:
+            conn.execute("INSERT OR IGNORE INTO queues VALUES (?, ?)", (QueueName, visibility_timeout))
+        return {'QueueUrl': f'local://sqs/{QueueName}'}
+
+    def get_queue_url(self, QueueName):
+        with self._transaction() as conn:
+            self._queue(conn, QueueName)
+        return {'QueueUrl': f'local://sqs/{QueueName}'}
+
+    def purge_queue(self, QueueUrl):
+        with self._transaction() as conn:
+            name, _ = self._queue(conn, QueueUrl)
+            conn.execute("DELETE FROM messages WHERE queue = ?", (name,))
+        return {}
+
+    def get_queue_attributes(self, QueueUrl, AttributeNames=None):
+        now = time.time()
+        with self._transaction() as conn:
+            name, _ = self._queue(conn, QueueUrl)
+            visible, in_flight = conn.execute(
+                "SELECT COALESCE(SUM(visible_at <= ?), 0), COALESCE(SUM(visible_at > ?), 0) FROM messages "
+                "WHERE queue = ?", (now, now, name)).fetchone()
+        return {'Attributes': {'ApproximateNumberOfMessages': str(visible),
+                               'ApproximateNumberOfMessagesNotVisible': str(in_flight)}}
+
+    def _insert(self, conn, name, body, attributes, delay=0):
+        message_id = str(uuid.uuid4())
+        conn.execute("INSERT INTO messages (queue, message_id, body, attributes, visible_at) VALUES (?, ?, ?, ?, ?)",
+                     (name, message_id, body, pickle.dumps(attributes or {}), time.time() + delay))
+        return message_id
+
+    def send_message(self, QueueUrl, MessageBody, MessageAttributes=None, DelaySeconds=0):
+        with self._transaction() as conn:
+            name, _ = self._queue(conn, QueueUrl)
+            message_id = self._insert(conn, name, MessageBody, MessageAttributes, DelaySeconds)
+        return {'MessageId': message_id}
+
+    def send_message_batch(self, QueueUrl, Entries):
+        successful = []
+        with self._transaction() as conn:
+            name, _ = self._queue(conn, QueueUrl)
+            for entry in Entries:
+                message_id = self._insert(conn, name, entry['MessageBody'], entry.get('MessageAttributes'),
+                                          entry.get('DelaySeconds', 0))
+                successful.append({'Id': entry['Id'], 'MessageId': message_id})
+        return {'Successful': successful, 'Failed': []}
+
+    def _claim(self, name, default_timeout, max_messages, visibility_timeout, attribute_names):
+        now = time.time()
+        timeout = default_timeout if visibility_timeout is None else visibility_timeout
+        with self._transaction() as conn:
+            rows = conn.execute("SELECT seq, message_id, body, attributes FROM messages "
+                                "WHERE queue = ? AND visible_at <= ? ORDER BY seq LIMIT ?",
+                                (name, now, max_messages)).fetchall()
+            messages = []
+            for seq, message_id, body, attributes in rows:
+                receipt = f"{seq}:{uuid.uuid4().hex}"
+                conn.execute("UPDATE messages SET visible_at = ?, receipt = ? WHERE seq = ?", (now + timeout, receipt, seq))
+                message = {'MessageId': message_id, 'ReceiptHandle': receipt, 'Body': body}
+                attributes = pickle.loads(attributes)
+                if attribute_names and attributes:
+                    wanted = attributes if {'All', '.*'} & set(attribute_names) else \
+                        {key: value for key, value in attributes.items() if key in attribute_names}
+                    if wanted:
+                        message['MessageAttributes'] = wanted
+                messages.append(message)
+        return messages
+
+    def receive_message(self, QueueUrl, MaxNumberOfMessages=1, WaitTimeSeconds=0, VisibilityTimeout=None,
+                        MessageAttributeNames=None, AttributeNames=None):
+        with self._transaction() as conn:
+            name, default_timeout = self._queue(conn, QueueUrl)
+        deadline = time.time() + WaitTimeSeconds
+        while True:
+            messages = self._claim(name, default_timeout, min(MaxNumberOfMessages, 10), VisibilityTimeout,
+                                   MessageAttributeNames)
+            if messages:
+                return {'Messages': messages}
+            if time.time() >= deadline:
+                return {}
+            time.sleep(self.poll_interval)
+
+    def delete_message(self, QueueUrl, ReceiptHandle):
+        with self._transaction() as conn:
+            name, _ = self._queue(conn, QueueUrl)
+            # Like SQS, deleting with a stale receipt handle of a message that still exists is not an error
+            conn.execute("DELETE FROM messages WHERE queue = ? AND seq = ?", (name, int(ReceiptHandle.split(':')[0])))
+        return {}
+
+    def change_message_visibility_batch(self, QueueUrl, Entries):
+        successful, failed = [], []
+        now = time.time()
+        with self._transaction() as conn:
+            name, _ = self._queue(conn, QueueUrl)
+            for entry in Entries:
+                updated = conn.execute("UPDATE messages SET visible_at = ? WHERE queue = ? AND receipt = ?",
+                                       (now + entry['VisibilityTimeout'], name, entry['ReceiptHandle'])).rowcount
+                if updated:
+                    successful.append({'Id': entry['Id']})
+                else:
+                    failed.append({'Id': entry['Id'], 'Code': 'ReceiptHandleIsInvalid', 'SenderFault': True,
+                                   'Message': 'The receipt handle is no longer valid'})
+        return {'Successful': successful, 'Failed': failed}
+
+    def delete_message_batch(self, QueueUrl, Entries):
+        with self._transaction() as conn:
+            name, _ = self._queue(conn, QueueUrl)
+            for entry in Entries:
+                conn.execute("DELETE FROM messages WHERE queue = ? AND seq = ?",
+                             (name, int(entry['ReceiptHandle'].split(':')[0])))
+        return {'Successful': [{'Id': entry['Id']} for entry in Entries], 'Failed': []}
+
+
+class LocalBody:
+    """The parts of botocore's StreamingBody the tiers use."""
+
+    def __init__(self, data):
+        self.stream = io.BytesIO(data)
+
+    def read(self, amt=None):
+        return self.stream.read(amt)
+
+    def iter_chunks(self, chunk_size=1024):
+        while True:
+            chunk = self.stream.read(chunk_size)
+            if not chunk:
+                return
+            yield chunk
+
+    def close(self):
+        self.stream.close()
+
+
+class LocalS3:
+    """S3 buckets as directories under root: single puts, multipart uploads, gets, heads and listings.
+
+    Objects are written to a temp file and renamed into place, so readers in
+    other processes never see a partial object.
+    """
+
+    exceptions = LocalS3Exceptions
+
+    def __init__(self, root):
+        self.root = root
+        self.uploads = os.path.join(root, '.uploads')
+        os.makedirs(self.uploads, exist_ok=True)
+
+    def _path(self, bucket, key):
+        return os.path.join(self.root, bucket, *key.split('/'))
+
+    def _write(self, bucket, key, chunks):
+        path = self._path(bucket, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        md5 = hashlib.md5()
+        fd, tmp_path = tempfile.mkstemp(dir=self.uploads)
+        with os.fdopen(fd, 'wb') as f:
+            for chunk in chunks:
+                md5.update(chunk)
+                f.write(chunk)
+        os.replace(tmp_path, path)
+        return f'"{md5.hexdigest()}"'
+
+    def put_object(self, Bucket, Key, Body=b'', **kwargs):
+        if isinstance(Body, str):
+            Body = Body.encode()
+        elif hasattr(Body, 'read'):
+            Body = Body.read()
+        return {'ETag': self._write(Bucket, Key, [bytes(Body)])}
+
+    def get_object(self, Bucket, Key, **kwargs):
+        try:
+            with open(self._path(Bucket, Key), 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            raise NoSuchKey(f"{Bucket}/{Key}")
+        return {'Body': LocalBody(data), 'ContentLength': len(data), 'ETag': f'"{hashlib.md5(data).hexdigest()}"'}
+
+    def head_object(self, Bucket, Key, **kwargs):
+        response = self.get_object(Bucket, Key)
+        response.pop('Body').close()
+        return response
+
+    def download_file(self, Bucket, Key, Filename):
+        try:
+            shutil.copyfile(self._path(Bucket, Key), Filename)
+        except FileNotFoundError:
+            raise NoSuchKey(f"{Bucket}/{Key}")
+
+    def delete_object(self, Bucket, Key, **kwargs):
+        try:
+            os.remove(self._path(Bucket, Key))
+        except FileNotFoundError:
+            pass
+        return {}
+
+    def list_objects_v2(self, Bucket, Prefix='', **kwargs):
+        bucket_root = os.path.join(self.root, Bucket)
+        contents = []
+        for directory, _, files in os.walk(bucket_root):
+            for name in files:
+                path = os.path.join(directory, name)
+                key = os.path.relpath(path, bucket_root).replace(os.sep, '/')
+                if key.startswith(Prefix):
+                    contents.append({'Key': key, 'Size': os.path.getsize(path)})
+        contents.sort(key=lambda obj: obj['Key'])
+        response = {'KeyCount': len(contents), 'IsTruncated': False}
+        if contents:
+            response['Contents'] = contents
+        return response
+
+    def create_multipart_upload(self, Bucket, Key, **kwargs):
+        upload_id = uuid.uuid4().hex
+        os.makedirs(os.path.join(self.uploads, upload_id))
+        return {'UploadId': upload_id}
+
+    def _part_path(self, upload_id, part_number):
+        directory = os.path.join(self.uploads, upload_id)
+        if not os.path.isdir(directory):
+            raise NoSuchUpload(upload_id)
+        return os.path.join(directory, f'{part_number:05d}')
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        data = Body.read() if hasattr(Body, 'read') else bytes(Body)
+        with open(self._part_path(UploadId, PartNumber), 'wb') as f:
+            f.write(data)
+        return {'ETag': f'"{hashlib.md5(data).hexdigest()}"'}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        def parts():
+            for part in sorted(MultipartUpload['Parts'], key=lambda part: part['PartNumber']):
+                with open(self._part_path(UploadId, part['PartNumber']), 'rb') as f:
+                    yield f.read()
+        etag = self._write(Bucket, Key, parts())
+        shutil.rmtree(os.path.join(self.uploads, UploadId), ignore_errors=True)
+        return {'ETag': etag}
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        shutil.rmtree(os.path.join(self.uploads, UploadId), ignore_errors=True)
+        return {}
+
+
+def local_client(service, root):
+    """A stand-in client for service ('sqs' or 's3') keeping its state under root."""
+    os.makedirs(root, exist_ok=True)
+    if service == 'sqs':
+        return LocalSQS(os.path.join(root, 'sqs.db'))
+    if service == 's3':
+        return LocalS3(os.path.join(root, 's3'))
+    raise ValueError(f"No local stand-in for {service}, only sqs and s3 run locally")
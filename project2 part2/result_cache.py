@@ -0,0 +1,70 @@
+import time
+from collections import OrderedDict
+
+
+class ResultCache:
+    """Classification results keyed by the content hash of the uploaded image.
+
+    Entries live in an in-process LRU of at most max_entries that expire after
+    ttl_seconds; max_entries=0 disables the cache (see enabled). When a bucket is given, results are also written under
+    prefix/<digest> so other web-tier instances can reuse them; the shared
+    calls block and are meant to be run in an executor.
+    """
+
+    def __init__(self, max_entries=100000, ttl_seconds=3600, s3_client=None, bucket=None, prefix='result-cache/'):
+        if bucket and s3_client is None:
+            raise ValueError("An s3_client is required when the cache is backed by a bucket")
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.prefix = prefix
+        self.entries = OrderedDict()  # digest -> (result, stored_at), least recently used first
+        self.metrics = {'hits': 0, 'shared_hits': 0, 'misses': 0, 'stores': 0, 'evictions': 0, 'expired': 0}
+
+    @property
+    def enabled(self):
+        return self.max_entries > 0
+
+    def get(self, digest):
+        """Return the locally cached result for digest, or None."""
+        entry = self.entries.get(digest)
+        if entry is not None:
+            result, stored_at = entry
+            if time.time() - stored_at <= self.ttl_seconds:
+                self.entries.move_to_end(digest)
+                self.metrics['hits'] += 1
+                return result
+            del self.entries[digest]
+            self.metrics['expired'] += 1
+        self.metrics['misses'] += 1
+        return None
+
+    def put(self, digest, result):
+        self.entries[digest] = (result, time.time())
+        self.entries.move_to_end(digest)
+        self.metrics['stores'] += 1
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.metrics['evictions'] += 1
+
+    def fetch_shared(self, digest):
+        """Look digest up in the shared bucket (blocking). Returns the result or None."""
+        try:
+            response = self.s3_client.get_object(Bucket=self.bucket, Key=self.prefix + digest)
+        except self.s3_client.exceptions.NoSuchKey:
+            return None
+        age = time.time() - response['LastModified'].timestamp()
+        if age > self.ttl_seconds:
+            return None
+        self.metrics['shared_hits'] += 1
+        return response['Body'].read().decode('utf-8')
+
+    def store_shared(self, digest, result):
+        """Write a result to the shared bucket (blocking)."""
+        self.s3_client.put_object(Bucket=self.bucket, Key=self.prefix + digest, Body=result)
+
+    def stats(self):
+        lookups = self.metrics['hits'] + self.metrics['misses']
+        hits = self.metrics['hits'] + self.metrics['shared_hits']
+        return {'entries': len(self.entries), **self.metrics, 'hit_rate': hits / lookups if lookups else 0.0}
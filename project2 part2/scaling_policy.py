@@ -0,0 +1,168 @@
+import math
+from collections import deque, namedtuple
+
+# One observation of the request queue and the app tier, taken once per controller tick
+QueueSample = namedtuple('QueueSample', ['timestamp', 'visible', 'in_flight', 'instances'])
+
+
+class RateTracker:
+    """Estimates request arrival and drain rates from successive QueueSamples.
+
+    SQS only reports queue depths, so the drain rate is modelled as
+    instances * per_instance_throughput and the arrival rate is whatever
+    explains the change in backlog on top of that. Both are smoothed with an
+    exponentially weighted moving average.
+    """
+
+    def __init__(self, per_instance_throughput=1.0, smoothing=0.5, window=20):
+        self.per_instance_throughput = per_instance_throughput
+        self.smoothing = smoothing
+        self.samples = deque(maxlen=window)
+        self.arrival_rate = 0.0
+        self.drain_rate = 0.0
+
+    def _ewma(self, current, value):
+        return self.smoothing * value + (1 - self.smoothing) * current
+
+    def observe(self, sample):
+        if self.samples:
+            previous = self.samples[-1]
+            dt = sample.timestamp - previous.timestamp
+            if dt > 0:
+                backlog_change = (sample.visible + sample.in_flight) - (previous.visible + previous.in_flight)
+                drained = min(previous.instances * self.per_instance_throughput * dt,
+                              previous.visible + previous.in_flight + max(backlog_change, 0))
+                self.drain_rate = self._ewma(self.drain_rate, drained / dt)
+                self.arrival_rate = self._ewma(self.arrival_rate, max(0.0, backlog_change + drained) / dt)
+        self.samples.append(sample)
+
+    @property
+    def latest(self):
+        return self.samples[-1] if self.samples else None
+
+
+class ScalingPolicy:
+    """Maps the current queue state to a desired number of app-tier instances."""
+
+    name = None
+
+    def __init__(self, max_instances=20, min_instances=0):
+        self.max_instances = max_instances
+        self.min_instances = min_instances
+
+    def clamp(self, count):
+        return max(self.min_instances, min(self.max_instances, int(count)))
+
+    def desired_instances(self, tracker):
+        raise NotImplementedError
+
+
+class QueueLengthPolicy(ScalingPolicy):
+    """The original rule: one instance per visible message, up to max_instances."""
+
+    name = 'queue_length'
+
+    def desired_instances(self, tracker):
+        return self.clamp(tracker.latest.visible)
+
+
+class PredictivePolicy(ScalingPolicy):
+    """Sizes the tier for the backlog expected once new instances have booted.
+
+    The backlog is projected boot_time seconds ahead at the current arrival
+    and drain rates, then enough instances are asked for to keep up with
+    arrivals and clear that backlog within target_drain_seconds. Until two
+    samples have given a rate estimate it falls back to one instance per
+    queued message, and it asks for none once the backlog is empty.
+    """
+
+    name = 'predictive'
+
+    def __init__(self, max_instances=20, min_instances=0, per_instance_throughput=1.0, boot_time=60.0,
+                 target_drain_seconds=60.0):
+        super().__init__(max_instances, min_instances)
+        self.per_instance_throughput = per_instance_throughput
+        self.boot_time = boot_time
+        self.target_drain_seconds = target_drain_seconds
+
+    def desired_instances(self, tracker):
+        sample = tracker.latest
+        backlog = sample.visible + sample.in_flight
+        if backlog == 0:
+            # Nothing waiting or being processed; the smoothed arrival rate alone would hold instances idle
+            return self.clamp(0)
+        if len(tracker.samples) < 2:
+            # No rates yet, so size for the burst that is already queued
+            return self.clamp(backlog)
+        projected = max(0.0, backlog + (tracker.arrival_rate - tracker.drain_rate) * self.boot_time)
+        required_rate = tracker.arrival_rate + projected / self.target_drain_seconds
+        return self.clamp(math.ceil(required_rate / self.per_instance_throughput))
+
+
+# Policies selectable by name from the controller and the simulator
+POLICIES = {policy.name: policy for policy in (QueueLengthPolicy, PredictivePolicy)}
+
+
+class Autoscaler:
+    """Applies hysteresis and cooldowns on top of a ScalingPolicy.
+
+    Scale-out happens as soon as the policy asks for more instances (at most
+    once per scale_up_cooldown). Scale-in only happens once the policy has
+    asked for fewer instances continuously for scale_down_delay seconds, and
+    then only down to the largest count requested over that period, so a
+    brief dip in the queue does not terminate instances that are needed again
+    on the next tick.
+    """
+
+    def __init__(self, policy, tracker, scale_up_cooldown=0.0, scale_down_delay=60.0):
+        self.policy = policy
+        self.tracker = tracker
+        self.scale_up_cooldown = scale_up_cooldown
+        self.scale_down_delay = scale_down_delay
+        self.last_scale_up = float('-inf')
+        self.below_since = None
+        self.recent_desired = deque()
+
+    def decide(self, sample):
+        """Feed a new sample and return the instance count the tier should have now."""
+        self.tracker.observe(sample)
+        current = sample.instances
+        desired = self.policy.desired_instances(self.tracker)
+        now = sample.timestamp
+
+        if desired > current:
+            self.below_since = None
+            self.recent_desired.clear()
+            if now - self.last_scale_up < self.scale_up_cooldown:
+                return current
+            self.last_scale_up = now
+            return desired
+
+        if desired == current:
+            self.below_since = None
+            self.recent_desired.clear()
+            return current
+
+        # Policy wants fewer instances: wait for the request to hold before acting on it
+        if self.below_since is None:
+            self.below_since = now
+        self.recent_desired.append((now, desired))
+        while self.recent_desired and now - self.recent_desired[0][0] > self.scale_down_delay:
+            self.recent_desired.popleft()
+        if now - self.below_since < self.scale_down_delay:
+            return current
+        return max(desired for _, desired in self.recent_desired)
+
+
+def build_autoscaler(policy='queue_length', max_instances=20, per_instance_throughput=1.0, boot_time=60.0,
+                     target_drain_seconds=60.0, scale_up_cooldown=0.0, scale_down_delay=60.0):
+    """Build an Autoscaler for the named policy with the controller's usual settings."""
+    if policy not in POLICIES:
+        raise ValueError(f"Unknown scaling policy: {policy}")
+    if policy == 'predictive':
+        scaling_policy = PredictivePolicy(max_instances, per_instance_throughput=per_instance_throughput,
+                                          boot_time=boot_time, target_drain_seconds=target_drain_seconds)
+    else:
+        scaling_policy = POLICIES[policy](max_instances)
+    tracker = RateTracker(per_instance_throughput)
+    return Autoscaler(scaling_policy, tracker, scale_up_cooldown, scale_down_delay)
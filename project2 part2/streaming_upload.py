@@ -0,0 +1,229 @@
+import asyncio
+import hashlib
+import time
+try:
+    # python-multipart >= 0.0.13; the old 'multipart' name is deprecated and can be shadowed by an unrelated package
+    from python_multipart.multipart import MultipartParser, parse_options_header
+except ImportError:
+    from multipart.multipart import MultipartParser, parse_options_header
+
+# S3 rejects multipart parts below 5 MiB (except the last one)
+MIN_PART_SIZE = 5 * 1024 * 1024
+
+
+class S3StreamingUpload:
+    """Streams bytes into one S3 object as they arrive.
+
+    Objects that never reach part_size go up as a single put_object when the
+    stream ends; larger ones become a multipart upload with up to
+    max_concurrency parts in flight, each holding an executor thread only for
+    the duration of its own part.
+    """
+
+    def __init__(self, s3_client, bucket, key, executor, part_size=8 * 1024 * 1024, max_concurrency=4):
+        if part_size < MIN_PART_SIZE:
+            raise ValueError(f"part_size must be at least {MIN_PART_SIZE} bytes")
+        self.s3 = s3_client
+        self.bucket = bucket
+        self.key = key
+        self.executor = executor
+        self.part_size = part_size
+        self.slots = asyncio.Semaphore(max_concurrency)
+        self.buffer = bytearray()
+        self.upload_id = None
+        self.part_tasks = []
+        self.bytes_received = 0
+        self.started = time.time()
+
+    async def _run(self, fn, *args, **kwargs):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, lambda: fn(*args, **kwargs))
+
+    async def _upload_part(self, part_number, data):
+        try:
+            response = await self._run(self.s3.upload_part, Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+                                       PartNumber=part_number, Body=data)
+            return {'PartNumber': part_number, 'ETag': response['ETag']}
+        finally:
+            self.slots.release()
+
+    async def _flush_part(self, data):
+        if self.upload_id is None:
+            response = await self._run(self.s3.create_multipart_upload, Bucket=self.bucket, Key=self.key)
+            self.upload_id = response['UploadId']
+        # Waiting for a free slot applies backpressure to the request body instead of buffering it
+        await self.slots.acquire()
+        part_number = len(self.part_tasks) + 1
+        self.part_tasks.append(asyncio.ensure_future(self._upload_part(part_number, data)))
+
+    async def write(self, data):
+        self.buffer += data
+        self.bytes_received += len(data)
+        while len(self.buffer) >= self.part_size:
+            part = bytes(self.buffer[:self.part_size])
+            del self.buffer[:self.part_size]
+            await self._flush_part(part)
+
+    async def finish(self):
+        """Upload whatever is left and return (bytes, seconds) for the whole transfer."""
+        if self.upload_id is None:
+            await self._run(self.s3.put_object, Bucket=self.bucket, Key=self.key, Body=bytes(self.buffer))
+        else:
+            if self.buffer:
+                await self._flush_part(bytes(self.buffer))
+            parts = await asyncio.gather(*self.part_tasks)
+            await self._run(self.s3.complete_multipart_upload, Bucket=self.bucket, Key=self.key,
+                            UploadId=self.upload_id, MultipartUpload={'Parts': parts})
+        self.buffer = bytearray()
+        return self.bytes_received, time.time() - self.started
+
+    async def abort(self):
+        for task in self.part_tasks:
+            task.cancel()
+        await asyncio.gather(*self.part_tasks, return_exceptions=True)
+        if self.upload_id is not None:
+            await self._run(self.s3.abort_multipart_upload, Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+
+
+async def stream_file_field(request, field_name, open_sink):
+    """Parse a multipart/form-data request body as it arrives and stream one file field.
+
+    open_sink(filename) is called once the field's headers are parsed and must
+    return an object with async write(data) and finish(); the result of
+    finish() is returned along with the filename. Returns (None, None) if the
+    field is not present.
+    """
+    content_type, params = parse_options_header(request.headers.get('content-type', ''))
+    if content_type != b'multipart/form-data' or b'boundary' not in params:
+        raise ValueError("Expected a multipart/form-data request")
+
+    # The parser's callbacks are synchronous, so they only record events that are acted on after each write
+    events = []
+    header = {}
+
+    def on_header_field(data, start, end):
+        header['field'] = header.get('field', b'') + data[start:end]
+
+    def on_header_value(data, start, end):
+        header['value'] = header.get('value', b'') + data[start:end]
+
+    def on_header_end():
+        if header.pop('field', b'').lower() == b'content-disposition':
+            events.append(('disposition', header.get('value', b'')))
+        header.pop('value', None)
+
+    callbacks = {
+        'on_part_begin': lambda: events.append(('begin', None)),
+        'on_part_data': lambda data, start, end: events.append(('data', bytes(data[start:end]))),
+        'on_part_end': lambda: events.append(('end', None)),
+        'on_header_field': on_header_field,
+        'on_header_value': on_header_value,
+        'on_header_end': on_header_end,
+        'on_headers_finished': lambda: events.append(('headers', None)),
+    }
+    parser = MultipartParser(params[b'boundary'], callbacks)
+
+    filename = None
+    disposition = {}
+    sink = None
+    result = None
+    in_field = False
+    try:
+        async for chunk in request.stream():
+            parser.write(chunk)
+            for kind, data in events:
+                if kind == 'begin':
+                    disposition = {}
+                elif kind == 'disposition':
+                    disposition = parse_options_header(data)[1]
+                elif kind == 'headers':
+                    in_field = disposition.get(b'name', b'').decode() == field_name and sink is None \
+                        and result is None
+                    if in_field:
+                        filename = disposition.get(b'filename', b'').decode()
+                        sink = open_sink(filename)
+                elif kind == 'data' and in_field:
+                    await sink.write(data)
+                elif kind == 'end' and in_field:
+                    result = await sink.finish()
+                    in_field = False
+            events.clear()
+        parser.finalize()
+    except BaseException:
+        if sink is not None and result is None and hasattr(sink, 'abort'):
+            await sink.abort()
+        raise
+    if result is None:
+        if sink is not None and hasattr(sink, 'abort'):
+            await sink.abort()
+        return None, None
+    return filename, result
+
+
+class InlineOrS3Upload:
+    """Keeps payloads up to inline_threshold bytes in memory and streams anything larger to S3.
+
+    finish() returns (bytes, seconds, payload) where payload is the whole body
+    when it stayed inline and None when it was written to S3.
+    """
+
+    def __init__(self, inline_threshold, open_s3_upload):
+        self.inline_threshold = inline_threshold
+        self.open_s3_upload = open_s3_upload
+        self.buffer = bytearray()
+        self.upload = None
+        self.started = time.time()
+
+    async def write(self, data):
+        if self.upload is None and len(self.buffer) + len(data) <= self.inline_threshold:
+            self.buffer += data
+            return
+        if self.upload is None:
+            # Too big to inline, switch to the S3 claim-check path with what has been buffered so far
+            self.upload = self.open_s3_upload()
+            await self.upload.write(bytes(self.buffer))
+            self.buffer = bytearray()
+        await self.upload.write(data)
+
+    async def finish(self):
+        if self.upload is None and not self.buffer:
+            # Nothing to inline (empty body, or inlining disabled), keep the S3 path
+            self.upload = self.open_s3_upload()
+        if self.upload is not None:
+            size, seconds = await self.upload.finish()
+            return size, seconds, None
+        return len(self.buffer), time.time() - self.started, bytes(self.buffer)
+
+    async def abort(self):
+        if self.upload is not None:
+            await self.upload.abort()
+
+
+class HashingUpload:
+    """Wraps another upload sink and hashes the bytes as they stream through it.
+
+    finish() returns (hex digest, inner finish() result, found). If lookup is
+    given it is awaited with the digest before the inner sink finishes; when
+    it returns something other than None that is found, the inner upload is
+    aborted instead (so a body still buffered below a part size is never
+    put) and the inner result is None.
+    """
+
+    def __init__(self, inner, algorithm='sha256', lookup=None):
+        self.inner = inner
+        self.hasher = hashlib.new(algorithm)
+        self.lookup = lookup
+
+    async def write(self, data):
+        self.hasher.update(data)
+        await self.inner.write(data)
+
+    async def finish(self):
+        digest = self.hasher.hexdigest()
+        found = await self.lookup(digest) if self.lookup is not None else None
+        if found is not None:
+            await self.inner.abort()
+            return digest, None, found
+        return digest, await self.inner.finish(), None
+
+    async def abort(self):
+        await self.inner.abort()
@@ -0,0 +1,216 @@
+import json
+import os
+import threading
+import time
+from clients import get_client, queue_url
+from collections import deque
+
+
+class StageLatencies:
+    """Recent durations per pipeline stage, with percentiles over the last window samples."""
+
+    def __init__(self, window=500):
+        self.window = window
+        self.samples = {}
+        self.lock = threading.Lock()
+
+    def record(self, stage, seconds):
+        with self.lock:
+            self.samples.setdefault(stage, deque(maxlen=self.window)).append(seconds)
+
+    def summary(self):
+        with self.lock:
+            snapshot = {stage: sorted(values) for stage, values in self.samples.items() if values}
+        return {stage: {'count': len(values),
+                        'p50': round(values[len(values) // 2], 4),
+                        'p95': round(values[min(len(values) - 1, int(len(values) * 0.95))], 4)}
+                for stage, values in snapshot.items()}
+
+
+class FileSink:
+    """Appends one JSON heartbeat per line to a local file."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def send(self, beat):
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(beat) + "\n")
+
+
+class SqsSink:
+    """Sends heartbeats as JSON messages to an SQS queue the controller consumes."""
+
+    def __init__(self, sqs_client, queue_name, region_name=None):
+        self.sqs = sqs_client
+        self.queue_name = queue_name
+        self.region_name = region_name
+
+    def send(self, beat):
+        # Resolved through the shared cache like the request and response queues
+        self.sqs.send_message(QueueUrl=queue_url(self.queue_name, self.region_name), MessageBody=json.dumps(beat))
+
+
+class CloudWatchSink:
+    """Publishes throughput and p95 stage latencies as CloudWatch metrics, one dimension per instance."""
+
+    def __init__(self, cloudwatch_client, namespace):
+        self.cloudwatch = cloudwatch_client
+        self.namespace = namespace
+
+    def send(self, beat):
+        dimensions = [{'Name': 'InstanceId', 'Value': beat['instance_id']}]
+        metrics = [{'MetricName': 'ImagesPerSecond', 'Dimensions': dimensions, 'Value': beat['images_per_sec'],
+                    'Unit': 'Count/Second'}]
+        for stage, stats in beat['stages'].items():
+            metrics.append({'MetricName': f'{stage}LatencyP95', 'Dimensions': dimensions, 'Value': stats['p95'],
+                            'Unit': 'Seconds'})
+        self.cloudwatch.put_metric_data(Namespace=self.namespace, MetricData=metrics)
+
+
+def build_sink(spec, region):
+    """Build a sink from 'file:<path>', 'sqs:<queue name>' or 'cloudwatch:<namespace>'."""
+    kind, _, target = spec.partition(':')
+    if kind == 'file':
+        return FileSink(target)
+    if kind == 'sqs':
+        return SqsSink(get_client('sqs', region), target, region)
+    if kind == 'cloudwatch':
+        return CloudWatchSink(get_client('cloudwatch', region), target)
+    raise ValueError(f"Unknown heartbeat sink: {spec}")
+
+
+class Heartbeat:
+    """Background thread that reports a worker's throughput and stage latencies every interval seconds."""
+
+    def __init__(self, sink, instance_id, interval=30, model_load_seconds=None):
+        self.sink = sink
+        self.instance_id = instance_id
+        self.interval = interval
+        self.model_load_seconds = model_load_seconds
+        self.latencies = StageLatencies()
+        self.images = 0
+        self.started_at = time.time()
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def record_images(self, count):
+        with self.lock:
+            self.images += count
+
+    def record_stage(self, stage, seconds):
+        self.latencies.record(stage, seconds)
+
+    def beat(self, previous_images, previous_time):
+        now = time.time()
+        with self.lock:
+            images = self.images
+        return {
+            'instance_id': self.instance_id,
+            'pid': os.getpid(),
+            'timestamp': now,
+            'started_at': self.started_at,
+            'model_load_seconds': self.model_load_seconds,
+            'images_total': images,
+            'images_per_sec': round((images - previous_images) / max(now - previous_time, 1e-6), 4),
+            'stages': self.latencies.summary(),
+        }
+
+    def _run(self):
+        previous_images, previous_time = 0, self.started_at
+        failures = 0
+        while True:
+            time.sleep(self.interval)
+            beat = self.beat(previous_images, previous_time)
+            previous_images, previous_time = beat['images_total'], beat['timestamp']
+            try:
+                self.sink.send(beat)
+                failures = 0
+            except Exception as e:
+                # Telemetry must never take the worker down; only log the first failure in a row
+                if failures == 0:
+                    print(f"Heartbeat failed: {e}")
+                failures += 1
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        return self
+
+
+class WorkerMonitor:
+    """Controller-side view of worker heartbeats: measured per-instance throughput and stalled workers.
+
+    An instance counts as stalled when it has sent no heartbeat for
+    stall_timeout seconds (counted from when the controller first saw it, so
+    booting instances get the same grace), or when it has not finished a
+    single image for stall_timeout seconds while requests were waiting.
+    Throughput is the median images/sec of the instances that reported while
+    there was a backlog, smoothed across ticks; idle instances would only
+    drag it down.
+    """
+
+    def __init__(self, stall_timeout=300, smoothing=0.3):
+        self.stall_timeout = stall_timeout
+        self.smoothing = smoothing
+        self.workers = {}        # (instance id, pid) -> latest heartbeat
+        self.last_beat = {}      # instance id -> time of its latest heartbeat
+        self.last_progress = {}  # instance id -> last time it finished an image or had nothing to do
+        self.first_seen = {}     # instance id -> when the controller first saw it active
+        self.throughput = None
+        self.beats = 0
+
+    def ingest(self, beat):
+        instance, key = beat['instance_id'], (beat['instance_id'], beat['pid'])
+        previous = self.workers.get(key)
+        self.workers[key] = beat
+        self.beats += 1
+        self.last_beat[instance] = max(self.last_beat.get(instance, 0.0), beat['timestamp'])
+        if beat['images_total'] > (previous['images_total'] if previous else 0):
+            self.last_progress[instance] = max(self.last_progress.get(instance, 0.0), beat['timestamp'])
+
+    def instance_throughput(self, instance_id, now):
+        # Sum over the instance's worker processes that are still reporting
+        return sum(beat['images_per_sec'] for (inst, _), beat in self.workers.items()
+                   if inst == instance_id and now - beat['timestamp'] <= self.stall_timeout)
+
+    def forget(self, instance_id):
+        for table in (self.first_seen, self.last_beat, self.last_progress):
+            table.pop(instance_id, None)
+        for key in [key for key in self.workers if key[0] == instance_id]:
+            del self.workers[key]
+
+    def update(self, instance_ids, backlog, now):
+        """Track the active instances, refresh the throughput estimate and return the stalled instance ids."""
+        for instance in [inst for inst in self.first_seen if inst not in instance_ids]:
+            self.forget(instance)  # retired, or stopped into the warm pool
+        stalled = []
+        busy_rates = []
+        for instance in instance_ids:
+            first_seen = self.first_seen.setdefault(instance, now)
+            if backlog == 0:
+                self.last_progress[instance] = now
+            last_beat = max(self.last_beat.get(instance, first_seen), first_seen)
+            last_progress = max(self.last_progress.get(instance, first_seen), first_seen)
+            if now - last_beat > self.stall_timeout or now - last_progress > self.stall_timeout:
+                stalled.append(instance)
+            elif backlog > 0 and instance in self.last_beat:
+                rate = self.instance_throughput(instance, now)
+                if rate > 0:
+                    busy_rates.append(rate)
+        if busy_rates:
+            median = sorted(busy_rates)[len(busy_rates) // 2]
+            self.throughput = median if self.throughput is None else \
+                self.smoothing * median + (1 - self.smoothing) * self.throughput
+        return stalled
+
+    def summary(self, now):
+        instances = {}
+        for (instance, pid), beat in self.workers.items():
+            entry = instances.setdefault(instance, {'images_per_sec': 0.0, 'workers': {}})
+            entry['images_per_sec'] = round(entry['images_per_sec'] + beat['images_per_sec'], 4)
+            entry['workers'][pid] = {'age': round(now - beat['timestamp'], 1), 'images_total': beat['images_total'],
+                                     'model_load_seconds': beat['model_load_seconds'], 'stages': beat['stages']}
+        return {'heartbeats': self.beats,
+                'measured_throughput': round(self.throughput, 4) if self.throughput is not None else None,
+                'instances': instances}
@@ -1,95 +1,197 @@
 __copyright__   = "Copyright 2024, VISA Lab"
 __license__     = "MIT"
 
-import sys
+import aiohttp
+import argparse
+import asyncio
+import csv
+import json
+import math
 import os
+import random
 import time
-import _thread
-import argparse
-import requests
-import subprocess
-import numpy as np
-import pandas as pd
-import threading
-from concurrent.futures import ThreadPoolExecutor
-from concurrent.futures import as_completed
-
-parser = argparse.ArgumentParser(description='Upload images')
+
+parser = argparse.ArgumentParser(description='Upload images at a fixed arrival schedule (open loop) and report latencies')
 parser.add_argument('--num_request', type=int, help='one image per request')
 parser.add_argument('--url', type=str, help='URL to the backend server, e.g. http://3.86.108.221:8000/')
 parser.add_argument('--image_folder', type=str, help='the path of the folder where images are saved')
 parser.add_argument('--prediction_file', type=str, help='the path of the classification results file')
+parser.add_argument('--arrival', type=str, default='burst', choices=['constant', 'poisson', 'burst'],
+                    help='arrival process: evenly spaced, exponential gaps, or bursts of --burst_size at once '
+                         '(the default, one burst of every request, is the original generator)')
+parser.add_argument('--rate', type=float, default=10.0, help='requests/sec for constant and poisson arrivals')
+parser.add_argument('--burst_size', type=int, default=None, help='requests per burst for burst arrivals (default all of them)')
+parser.add_argument('--burst_interval', type=float, default=30.0, help='seconds between bursts')
+parser.add_argument('--connections', type=int, default=100, help='pooled keep-alive connections to the server')
+parser.add_argument('--timeout', type=float, default=600.0, help='seconds before a request counts as failed')
+parser.add_argument('--seed', type=int, default=None, help='random seed for poisson arrivals')
+parser.add_argument('--json_output', type=str, default=None, help='also write the results to this JSON file')
 args = parser.parse_args()
 
-num_request     = args.num_request
-url             = args.url
-image_folder    = args.image_folder
-prediction_file = args.prediction_file
-prediction_df   = pd.read_csv(prediction_file)
-responses       = 0
-err_responses   = 0
-correct_predictions = 0
-wrong_predictions   = 0
-ex_requests         = []
-
-def send_one_request(image_path):
-    global prediction_df, responses, err_responses, correct_predictions, wrong_predictions, ex_requests
-    # Define http payload, "myfile" is the key of the http payload
-    file = {"inputFile": open(image_path,'rb')}
-    try:
-        response = requests.post(url, files=file)
-        # Print error message if failed
-        if response.status_code != 200:
-            print('sendErr: '+response.url)
-            err_responses +=1
-        else :
-            filename    = os.path.basename(image_path)
-            image_msg   = filename + ' uploaded!'
-            msg         = image_msg + '\n' + 'Classification result: ' + response.text
-            print(msg)
-            responses   +=1
-            correct_result = prediction_df.loc[prediction_df['Image'] == filename.split('.')[0], 'Results'].iloc[0]
-            if correct_result.strip() == response.text.split(':')[1].strip():
-                correct_predictions +=1
-            else:
-                wrong_predictions +=1
-    except requests.exceptions.RequestException as errex:
-        print("Exception:", errex)
-        ex_requests.append(image_path)
-
-num_max_workers = 100
-image_path_list = []
-test_start_time = time.time()
 
-for i, name in enumerate(os.listdir(image_folder)):
-    if i == num_request:
-        break
-    image_path_list.append(os.path.join(image_folder,name))
+class LatencyHistogram:
+    """Latencies in log-spaced buckets, each precision wide relative to its value.
+
+    Memory stays bounded however many requests are recorded, and every
+    reported percentile is within precision of the exact value (max is exact).
+    """
+
+    def __init__(self, precision=0.01, min_value=1e-4):
+        self.precision = precision
+        self.min_value = min_value
+        self.counts = {}
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def _bucket(self, seconds):
+        return int(math.log(max(seconds, self.min_value) / self.min_value) / math.log1p(self.precision))
+
+    def _upper_bound(self, bucket):
+        return self.min_value * (1 + self.precision) ** (bucket + 1)
+
+    def record(self, seconds):
+        bucket = self._bucket(seconds)
+        self.counts[bucket] = self.counts.get(bucket, 0) + 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def percentile(self, q):
+        if not self.count:
+            return None
+        rank = max(1, math.ceil(q * self.count))
+        seen = 0
+        for bucket in sorted(self.counts):
+            seen += self.counts[bucket]
+            if seen >= rank:
+                return min(self._upper_bound(bucket), self.max)
+        return self.max
+
+    def summary(self):
+        return {'count': self.count, 'mean': self.total / self.count if self.count else None,
+                'p50': self.percentile(0.5), 'p95': self.percentile(0.95), 'p99': self.percentile(0.99),
+                'max': self.max if self.count else None}
+
+    def buckets(self):
+        return [[round(self._upper_bound(bucket), 6), self.counts[bucket]] for bucket in sorted(self.counts)]
 
-with ThreadPoolExecutor(max_workers = num_max_workers) as executor:
-    executor.map(send_one_request, image_path_list)
 
-print(f"Attempt-1 {responses}/{num_request} requests successful.")
+def arrival_offsets(count):
+    # Seconds after the start at which each request is due, independent of how fast responses come back
+    if args.arrival == 'constant':
+        return [i / args.rate for i in range(count)]
+    if args.arrival == 'burst':
+        burst_size = args.burst_size or count
+        return [(i // burst_size) * args.burst_interval for i in range(count)]
+    rng = random.Random(args.seed)
+    offsets, t = [], 0.0
+    for _ in range(count):
+        offsets.append(t)
+        t += rng.expovariate(args.rate)
+    return offsets
 
-# Retry requests until all requests are successful or ex_requests is empty
-retry_attempt=2
-while ex_requests:
-    retry_requests = ex_requests.copy()
-    ex_requests.clear()
-    with ThreadPoolExecutor(max_workers=num_max_workers) as executor:
-        executor.map(send_one_request, retry_requests)
-    print(f"Attempt-{retry_attempt} {responses}/{num_request} requests successful.")
-    retry_attempt += 1
 
+# Expected results by image name, and every image read into memory once
+with open(args.prediction_file) as f:
+    expected_results = {row['Image']: row['Results'].strip() for row in csv.DictReader(f)}
+images = []
+for name in sorted(os.listdir(args.image_folder))[:args.num_request]:
+    with open(os.path.join(args.image_folder, name), 'rb') as f:
+        images.append((name, f.read()))
+if not images:
+    raise SystemExit(f"No images found in {args.image_folder}")
+num_request = args.num_request or len(images)
+
+# Only touched from the event loop, so no locks are needed
+stats = {'responses': 0, 'err_responses': 0, 'exceptions': 0, 'correct_predictions': 0, 'wrong_predictions': 0,
+         'max_schedule_lag': 0.0}
+# latency counts from when a request was due, so time spent queued behind slow responses (coordinated
+# omission) is included; service_latency counts from when it was actually issued. Failed and timed-out
+# requests are recorded at the time they took to fail, so they stay in the tail instead of vanishing from it
+latency = LatencyHistogram()
+service_latency = LatencyHistogram()
+
+
+async def send_one_request(session, name, data, due):
+    loop = asyncio.get_running_loop()
+    issued = loop.time()
+    stats['max_schedule_lag'] = max(stats['max_schedule_lag'], issued - due)
+    form = aiohttp.FormData()
+    form.add_field('inputFile', data, filename=name)
+    try:
+        async with session.post(args.url, data=form) as response:
+            text = await response.text()
+            status = response.status
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        finished = loop.time()
+        latency.record(finished - due)
+        service_latency.record(finished - issued)
+        stats['exceptions'] += 1
+        print(f"Exception for {name}: {e!r}")
+        return
+    finished = loop.time()
+    latency.record(finished - due)
+    service_latency.record(finished - issued)
+    if status != 200:
+        stats['err_responses'] += 1
+        print(f"sendErr: {name} status {status}")
+        return
+    stats['responses'] += 1
+    print(f"{name} uploaded!\nClassification result: {text}")
+    predicted = text.split(':', 1)[1].strip() if ':' in text else None
+    if predicted == expected_results.get(os.path.splitext(name)[0]):
+        stats['correct_predictions'] += 1
+    else:
+        stats['wrong_predictions'] += 1
+
+
+async def generate_load():
+    loop = asyncio.get_running_loop()
+    connector = aiohttp.TCPConnector(limit=args.connections)
+    timeout = aiohttp.ClientTimeout(total=args.timeout)
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        start = loop.time()
+        tasks = []
+        for i, offset in enumerate(arrival_offsets(num_request)):
+            due = start + offset
+            if due > loop.time():
+                await asyncio.sleep(due - loop.time())
+            name, data = images[i % len(images)]
+            tasks.append(asyncio.create_task(send_one_request(session, name, data, due)))
+        await asyncio.gather(*tasks)
+
+
+test_start_time = time.time()
+asyncio.run(generate_load())
 test_duration = time.time() - test_start_time
-print("All requests have been processed or retried.")
-
-if num_request == (responses + err_responses):
-   print (f"+++++ Test Result Statistics +++++")
-   print (f"Total number of requests: {num_request}")
-   print (f"Total number of requests completed successfully: {responses}")
-   print (f"Total number of failed requests: {err_responses}")
-   print (f"Total number of correct predictions : {correct_predictions}")
-   print (f"Total number of wrong predictions: {wrong_predictions}")
-   print (f"Total Test Duration: {test_duration} (seconds)")
-   print ("++++++++++++++++++++++++++++++++++++")
\ No newline at end of file
+
+results = {
+    'config': {'num_request': num_request, **{key: getattr(args, key) for key in (
+        'url', 'arrival', 'rate', 'burst_size', 'burst_interval', 'connections', 'seed')}},
+    'duration': test_duration,
+    'throughput': stats['responses'] / test_duration,
+    **stats,
+    'latency': latency.summary(),
+    'service_latency': service_latency.summary(),
+    'latency_histogram': latency.buckets(),
+}
+
+print(f"+++++ Test Result Statistics +++++")
+print(f"Total number of requests: {num_request}")
+print(f"Total number of requests completed successfully: {stats['responses']}")
+print(f"Total number of failed requests: {stats['err_responses'] + stats['exceptions']}")
+print(f"Total number of correct predictions : {stats['correct_predictions']}")
+print(f"Total number of wrong predictions: {stats['wrong_predictions']}")
+print(f"Total Test Duration: {test_duration} (seconds)")
+for label, summary in (('Latency (from due time, failures included)', results['latency']),
+                       ('Service latency (from send)', results['service_latency'])):
+    if summary['count']:
+        print(f"{label}: p50 {summary['p50']:.3f}s p95 {summary['p95']:.3f}s p99 {summary['p99']:.3f}s "
+              f"max {summary['max']:.3f}s")
+print(f"Max schedule lag: {stats['max_schedule_lag']:.3f}s")
+print("++++++++++++++++++++++++++++++++++++")
+
+if args.json_output:
+    with open(args.json_output, 'w') as f:
+        json.dump(results, f, indent=2)
@@ -1,8 +1,8 @@
 import subprocess
 import os
-import boto3
 import json
 import urllib.parse
+from clients import get_client
 
 
 def split_video_into_exactly_10_frames(video_path, output_dir, num_frames=10):
@@ -44,9 +44,11 @@ def split_video_into_exactly_10_frames(video_path, output_dir, num_frames=10):
         raise
 
 
-def handler(event, context):
+# One pooled, keep-alive client per container, reused by every warm invocation
+s3_client = get_client('s3')
+
 
-    s3_client = boto3.client('s3')
+def handler(event, context):
 
     # Extract bucket name and object key from the event
     try:
@@ -0,0 +1,220 @@
+import numpy as np
+from face_matcher import FaceMatcher
+from gallery_format import NameTable, encode_names
+
+
+def _to_numpy(x):
+    # Accept torch tensors (the resnet output) as well as numpy arrays
+    if hasattr(x, 'detach'):
+        x = x.detach().cpu().numpy()
+    return np.asarray(x, dtype=np.float32)
+
+
+def _squared_distances(queries, points, points_sq_norms=None):
+    # (Q, D) x (N, D) -> (Q, N) squared euclidean distances through one matmul
+    if points_sq_norms is None:
+        points_sq_norms = np.einsum('ij,ij->i', points, points)
+    query_sq_norms = np.einsum('ij,ij->i', queries, queries)[:, None]
+    sq_dists = query_sq_norms + points_sq_norms[None, :] - 2.0 * (queries @ points.T)
+    return np.maximum(sq_dists, 0.0, out=sq_dists)
+
+
+def kmeans(data, n_clusters, n_iter=15, max_train=100000, seed=0):
+    """Plain Lloyd's k-means on a sample of data, returns the (n_clusters, D) centroids."""
+    rng = np.random.default_rng(seed)
+    if len(data) > max_train:
+        data = data[rng.choice(len(data), max_train, replace=False)]
+    n_clusters = min(n_clusters, len(data))
+    centroids = data[rng.choice(len(data), n_clusters, replace=False)].copy()
+
+    for _ in range(n_iter):
+        assign = _squared_distances(data, centroids).argmin(axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assign, data)
+        counts = np.bincount(assign, minlength=n_clusters)
+        empty = counts == 0
+        centroids[~empty] = sums[~empty] / counts[~empty, None]
+        # Re-seed empty clusters from random points so every list stays usable
+        if empty.any():
+            centroids[empty] = data[rng.choice(len(data), int(empty.sum()), replace=False)]
+    return centroids
+
+
+def assign_to_centroids(data, centroids, chunk_size=65536):
+    """Nearest centroid for every row of data, computed in chunks to bound memory."""
+    centroid_sq_norms = np.einsum('ij,ij->i', centroids, centroids)
+    assign = np.empty(len(data), dtype=np.int64)
+    for start in range(0, len(data), chunk_size):
+        chunk = data[start:start + chunk_size]
+        assign[start:start + chunk_size] = _squared_distances(chunk, centroids, centroid_sq_norms).argmin(axis=1)
+    return assign
+
+
+class IVFIndex:
+    """Inverted-file approximate nearest-neighbour index over the data.pt gallery.
+
+    The gallery is split into n_lists k-means cells and a query only scans the
+    nprobe closest cells. With pq_subvectors set, vectors are stored as
+    product-quantized uint8 codes of their residuals instead of full floats,
+    which cuts memory by roughly 4*D/pq_subvectors at some cost in recall.
+    Exposes the same match/match_batch/topk/topk_batch calls as FaceMatcher.
+    """
+
+    def __init__(self, embedding_list, name_list, n_lists=None, nprobe=8, pq_subvectors=None,
+                 store_dtype=np.float32, seed=0):
+        if len(embedding_list) != len(name_list):
+            raise ValueError(f"Gallery has {len(embedding_list)} embeddings but {len(name_list)} names")
+        if len(embedding_list) == 0:
+            raise ValueError("Gallery is empty")
+
+        if isinstance(embedding_list, (list, tuple)):
+            data = np.stack([_to_numpy(emb).reshape(-1) for emb in embedding_list])
+        else:
+            data = _to_numpy(embedding_list).reshape(len(name_list), -1)
+        self.names = name_list if isinstance(name_list, NameTable) else list(name_list)
+        self.nprobe = nprobe
+        self.pq_subvectors = pq_subvectors
+        if pq_subvectors and data.shape[1] % pq_subvectors:
+            raise ValueError(f"Dimension {data.shape[1]} is not divisible by pq_subvectors={pq_subvectors}")
+
+        # Roughly sqrt(N) cells keeps both the coarse and the fine scan small
+        if n_lists is None:
+            n_lists = max(1, int(np.sqrt(len(data))))
+        self.centroids = kmeans(data, n_lists, seed=seed)
+        assign = assign_to_centroids(data, self.centroids)
+
+        # Reorder vectors so every inverted list is one contiguous slice
+        order = np.argsort(assign, kind='stable')
+        self.ids = order
+        self.list_offsets = np.concatenate([[0], np.cumsum(np.bincount(assign, minlength=len(self.centroids)))])
+        data = data[order]
+
+        if pq_subvectors:
+            residuals = data - self.centroids[assign[order]]
+            self.pq_codebooks = self._train_pq(residuals, seed)
+            self.codes = self._encode_pq(residuals)
+            self.vectors = self.vector_sq_norms = None
+        else:
+            self.vectors = data.astype(store_dtype)
+            self.vector_sq_norms = np.einsum('ij,ij->i', data, data)
+            self.pq_codebooks = self.codes = None
+
+    # Arrays that make up a built index, used by save/load
+    _saved_fields = ('centroids', 'ids', 'list_offsets', 'vectors', 'vector_sq_norms', 'pq_codebooks', 'codes')
+
+    def save(self, path):
+        """Write the built index to an .npz file (or open binary file) so workers do not re-run k-means on startup."""
+        arrays = {name: getattr(self, name) for name in self._saved_fields if getattr(self, name, None) is not None}
+        # Names in the flat gallery's offsets + blob layout, read back as a NameTable without decoding them all
+        name_offsets, name_blob = encode_names(self.names)
+        np.savez(path, name_offsets=name_offsets, name_blob=name_blob, nprobe=self.nprobe,
+                 pq_subvectors=self.pq_subvectors or 0, **arrays)
+
+    @classmethod
+    def load(cls, path, nprobe=None):
+        """Read an index written by save()."""
+        index = cls.__new__(cls)
+        with np.load(path) as saved:
+            for name in cls._saved_fields:
+                setattr(index, name, saved[name] if name in saved else None)
+            if 'name_offsets' in saved:
+                index.names = NameTable(saved['name_offsets'], saved['name_blob'])
+            else:
+                index.names = saved['names'].tolist()  # written before names were stored as a blob
+            index.nprobe = int(saved['nprobe']) if nprobe is None else nprobe
+            index.pq_subvectors = int(saved['pq_subvectors']) or None
+        return index
+
+    def _train_pq(self, residuals, seed):
+        # One 256-entry codebook per sub-vector so every code fits in a uint8
+        sub_dim = residuals.shape[1] // self.pq_subvectors
+        return np.stack([kmeans(np.ascontiguousarray(residuals[:, j * sub_dim:(j + 1) * sub_dim]), 256, seed=seed)
+                         for j in range(self.pq_subvectors)])
+
+    def _encode_pq(self, residuals):
+        sub_dim = residuals.shape[1] // self.pq_subvectors
+        codes = np.empty((len(residuals), self.pq_subvectors), dtype=np.uint8)
+        for j in range(self.pq_subvectors):
+            sub = np.ascontiguousarray(residuals[:, j * sub_dim:(j + 1) * sub_dim])
+            codes[:, j] = assign_to_centroids(sub, self.pq_codebooks[j])
+        return codes
+
+    def __len__(self):
+        return len(self.names)
+
+    @property
+    def dim(self):
+        return self.centroids.shape[1]
+
+    def _scan_list(self, query, list_id):
+        start, end = self.list_offsets[list_id], self.list_offsets[list_id + 1]
+        if start == end:
+            return np.empty(0, dtype=np.float32)
+        if self.vectors is not None:
+            vectors = self.vectors[start:end].astype(np.float32, copy=False)
+            return _squared_distances(query[None, :], vectors, self.vector_sq_norms[start:end])[0]
+        # Asymmetric distance: precompute |residual_j - codeword|^2 per sub-vector, then sum table lookups
+        residual = (query - self.centroids[list_id]).reshape(self.pq_subvectors, 1, -1)
+        table = ((residual - self.pq_codebooks) ** 2).sum(axis=2)
+        return table[np.arange(self.pq_subvectors), self.codes[start:end]].sum(axis=1)
+
+    def _search(self, query, coarse_sq_dists, k):
+        nprobe = min(self.nprobe, len(self.centroids))
+        probe = np.argpartition(coarse_sq_dists, nprobe - 1)[:nprobe]
+        sq_dists = np.concatenate([self._scan_list(query, list_id) for list_id in probe])
+        positions = np.concatenate([np.arange(self.list_offsets[list_id], self.list_offsets[list_id + 1])
+                                    for list_id in probe])
+        k = min(k, len(sq_dists))
+        if k == 0:
+            return []
+        best = np.argpartition(sq_dists, k - 1)[:k]
+        best = best[np.argsort(sq_dists[best])]
+        return [(self.names[self.ids[positions[i]]], float(np.sqrt(sq_dists[i]))) for i in best]
+
+    def topk_batch(self, embs, k=1):
+        """Return a list of k closest (name, distance) pairs for every query row in embs."""
+        queries = _to_numpy(embs).reshape(-1, self.dim)
+        coarse = _squared_distances(queries, self.centroids)
+        return [self._search(query, coarse_row, k) for query, coarse_row in zip(queries, coarse)]
+
+    def topk(self, emb, k=1):
+        """Return the k closest (name, distance) pairs for a single query embedding, closest first."""
+        return self.topk_batch(emb, k)[0]
+
+    def match(self, emb):
+        """Return (name, distance) of the closest gallery entry found in the probed lists."""
+        return self.topk(emb, k=1)[0]
+
+    def match_batch(self, embs):
+        """Return one (name, distance) pair per query row in embs."""
+        return [row[0] for row in self.topk_batch(embs, k=1)]
+
+
+def build_matcher(embedding_list, name_list, index='exact', **options):
+    """Build either the exact FaceMatcher or an IVFIndex over the same gallery."""
+    if index == 'exact':
+        return FaceMatcher(embedding_list, name_list)
+    if index == 'ivf':
+        return IVFIndex(embedding_list, name_list, **options)
+    raise ValueError(f"Unknown index type: {index}")
+
+
+if __name__ == "__main__":
+    import argparse
+    from gallery_format import load_gallery
+
+    parser = argparse.ArgumentParser(description='Prebuild the IVF index for a gallery, for GalleryStore to load '
+                                                 'instead of running k-means on every start')
+    parser.add_argument('source', type=str, help='data.pt or flat gallery file')
+    parser.add_argument('target', type=str, help='index file to write, e.g. data.pt.ivf.npz')
+    parser.add_argument('--n_lists', type=int, default=None, help='k-means cells (default sqrt of the gallery size)')
+    parser.add_argument('--nprobe', type=int, default=8, help='IVF cells scanned per query')
+    parser.add_argument('--pq_subvectors', type=int, default=None, help='store vectors product-quantized with this many sub-vectors')
+    args = parser.parse_args()
+
+    saved_data = load_gallery(args.source)
+    index = IVFIndex(saved_data[0], saved_data[1], n_lists=args.n_lists, nprobe=args.nprobe,
+                     pq_subvectors=args.pq_subvectors)
+    with open(args.target, 'wb') as f:
+        index.save(f)
+    print(f"Wrote an IVF index of {len(index)} embeddings in {len(index.centroids)} cells to {args.target}")
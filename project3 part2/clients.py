@@ -0,0 +1,131 @@
+import json
+import os
+import tempfile
+import threading
+
+# Set CSE546_LOCAL_AWS to a directory to run the tiers against the SQS/S3 stand-ins in local_aws.py,
+# e.g. for benchmark_pipeline.py; every process pointed at the same directory shares queues and buckets
+LOCAL_ROOT = os.environ.get('CSE546_LOCAL_AWS') or None
+
+# Queue URLs only change if the account or region does, so they are kept on disk between restarts
+QUEUE_URL_CACHE = os.environ.get('CSE546_QUEUE_URL_CACHE') or os.path.join(tempfile.gettempdir(),
+                                                                             'cse546-queue-urls.json')
+
+# boto3 and botocore take a few hundred milliseconds to import, so they are only imported (and the config
+# only built) when the first real client is made; see client_config for the settings
+_config = None
+
+# Clients are thread-safe and built once per (service, region) in each process; a forked worker gets its own
+# because connection pools must not be shared across processes
+_clients = {}
+_clients_lock = threading.Lock()
+_queue_urls = {}
+
+
+def client_config():
+    # botocore keeps 10 connections per client by default, fewer than the threads the tiers run boto3 calls on
+    # (web-tier executor and pollers, app-tier download/upload pools, controller collectors), so calls queued
+    # for a connection. Keep-alive lets idle pooled connections survive between bursts and long polls.
+    global _config
+    if _config is None:
+        from botocore.config import Config
+        _config = Config(
+            max_pool_connections=int(os.environ.get('AWS_MAX_POOL_CONNECTIONS', '50')),
+            retries={'max_attempts': 5, 'mode': 'adaptive'},
+            tcp_keepalive=True,
+            connect_timeout=5,
+            read_timeout=60,  # above the 20s SQS long poll
+        )
+    return _config
+
+
+def make_client(service, region_name=None):
+    """A new tuned boto3 client for service, or its local stand-in when CSE546_LOCAL_AWS is set."""
+    if LOCAL_ROOT:
+        # Only imported for local runs, so deployments (e.g. the Lambda images) do not need to ship local_aws.py
+        from local_aws import local_client
+        return local_client(service, LOCAL_ROOT)
+    import boto3
+    return boto3.client(service, region_name=region_name, config=client_config())
+
+
+def get_client(service, region_name=None):
+    """The cached client for service in this process, created on first use."""
+    key = (os.getpid(), service, region_name)
+    client = _clients.get(key)
+    if client is None:
+        # boto3's default session is not safe to create clients from concurrently
+        with _clients_lock:
+            client = _clients.get(key)
+            if client is None:
+                client = _clients[key] = make_client(service, region_name)
+    return client
+
+
+def get_resource(service, region_name=None):
+    """The cached boto3 resource for service in this process, created on first use (no local stand-in)."""
+    import boto3
+    key = (os.getpid(), service, region_name, 'resource')
+    with _clients_lock:
+        if key not in _clients:
+            _clients[key] = boto3.resource(service, region_name=region_name, config=client_config())
+        return _clients[key]
+
+
+class LazyClient:
+    """Stands in for get_client(service, region_name) at module level without creating the client at import.
+
+    Every attribute access goes through get_client, so the client is built
+    on first use and a forked process automatically gets its own.
+    """
+
+    def __init__(self, service, region_name=None):
+        self.service = service
+        self.region_name = region_name
+
+    def __getattr__(self, name):
+        return getattr(get_client(self.service, self.region_name), name)
+
+
+class LazyResource(LazyClient):
+    """LazyClient for get_resource(service, region_name)."""
+
+    def __getattr__(self, name):
+        return getattr(get_resource(self.service, self.region_name), name)
+
+
+def _load_queue_urls():
+    try:
+        with open(QUEUE_URL_CACHE) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _store_queue_urls(urls):
+    try:
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(QUEUE_URL_CACHE))
+        with os.fdopen(fd, 'w') as f:
+            json.dump(urls, f)
+        os.replace(tmp_path, QUEUE_URL_CACHE)
+    except OSError as e:
+        print(f"Could not cache queue URLs in {QUEUE_URL_CACHE}: {e}")
+
+
+def queue_url(queue_name, region_name=None):
+    """URL of queue_name, resolved with get_queue_url once and then served from memory or the disk cache."""
+    key = f"{region_name}/{queue_name}"
+    url = _queue_urls.get(key)
+    if url is not None:
+        return url
+    if LOCAL_ROOT:
+        url = get_client('sqs', region_name).get_queue_url(QueueName=queue_name)['QueueUrl']
+    else:
+        cached = _load_queue_urls()
+        url = cached.get(key)
+        if url is None:
+            url = get_client('sqs', region_name).get_queue_url(QueueName=queue_name)['QueueUrl']
+            cached[key] = url
+            _store_queue_urls(cached)
+    _queue_urls[key] = url
+    return url
@@ -0,0 +1,77 @@
+import torch
+from gallery_format import NameTable
+
+
+class FaceMatcher:
+    """Nearest-neighbour lookup over the embeddings stored in data.pt."""
+
+    def __init__(self, embedding_list, name_list):
+        if len(embedding_list) != len(name_list):
+            raise ValueError(f"Gallery has {len(embedding_list)} embeddings but {len(name_list)} names")
+        if len(embedding_list) == 0:
+            raise ValueError("Gallery is empty")
+
+        # Stack every stored embedding into one contiguous (N, D) matrix
+        if torch.is_tensor(embedding_list):
+            gallery = embedding_list.reshape(len(name_list), -1)
+        else:
+            gallery = torch.stack([torch.as_tensor(emb).reshape(-1) for emb in embedding_list])
+        self.gallery = gallery.detach().float().contiguous()
+        # A memory-mapped NameTable is indexed in place, only the names of matches are ever decoded
+        self.names = name_list if isinstance(name_list, NameTable) else list(name_list)
+        # Squared norms are reused by every query: |q - g|^2 = |q|^2 + |g|^2 - 2 q.g
+        self.gallery_sq_norms = (self.gallery * self.gallery).sum(dim=1)
+
+    @classmethod
+    def from_saved_data(cls, saved_data):
+        """Build a matcher from the [embedding_list, name_list] pair loaded from data.pt."""
+        return cls(saved_data[0], saved_data[1])
+
+    def __len__(self):
+        return len(self.names)
+
+    @property
+    def dim(self):
+        return self.gallery.shape[1]
+
+    def _squared_distances(self, queries):
+        # (Q, D) x (D, N) -> (Q, N) squared euclidean distances in a single matmul
+        query_sq_norms = (queries * queries).sum(dim=1, keepdim=True)
+        sq_dists = query_sq_norms + self.gallery_sq_norms.unsqueeze(0) - 2.0 * (queries @ self.gallery.T)
+        return sq_dists.clamp_(min=0.0)
+
+    def _as_queries(self, emb):
+        return torch.as_tensor(emb).detach().float().reshape(-1, self.dim)
+
+    def _exact_distances(self, queries, indices):
+        # Recompute the winning distances directly so they match torch.dist exactly
+        return (queries.unsqueeze(1) - self.gallery[indices]).norm(dim=2)
+
+    def topk(self, emb, k=1):
+        """Return the k closest (name, distance) pairs for a single query embedding, closest first."""
+        return self.topk_batch(emb, k)[0]
+
+    def topk_batch(self, embs, k=1):
+        """Return a list of k closest (name, distance) pairs for every query row in embs."""
+        queries = self._as_queries(embs)
+        k = min(k, len(self.names))
+        with torch.no_grad():
+            sq_dists = self._squared_distances(queries)
+            if k == 1:
+                indices = sq_dists.argmin(dim=1, keepdim=True)
+            else:
+                indices = sq_dists.topk(k, dim=1, largest=False).indices
+            distances = self._exact_distances(queries, indices)
+
+        results = []
+        for row_indices, row_distances in zip(indices.tolist(), distances.tolist()):
+            results.append([(self.names[idx], dist) for idx, dist in zip(row_indices, row_distances)])
+        return results
+
+    def match(self, emb):
+        """Return (name, distance) of the closest gallery entry, same result as the old face_match loop."""
+        return self.topk(emb, k=1)[0]
+
+    def match_batch(self, embs):
+        """Return one (name, distance) pair per query row in embs."""
+        return [row[0] for row in self.topk_batch(embs, k=1)]
@@ -0,0 +1,128 @@
+import argparse
+import struct
+import numpy as np
+import torch
+
+# Flat gallery layout, everything little-endian:
+#   header | (N, D) embedding matrix | (N + 1) int64 name offsets | utf-8 name blob
+# The matrix is 64-byte aligned so it can be memory-mapped and used in place.
+MAGIC = b'FGAL'
+VERSION = 1
+HEADER = struct.Struct('<4sIIQQQQQ')  # magic, version, dtype code, N, D, matrix/offsets/names positions
+ALIGNMENT = 64
+DTYPES = {0: np.float32, 1: np.float16}
+DTYPE_CODES = {np.dtype(dtype): code for code, dtype in DTYPES.items()}
+
+
+def _align(position):
+    return (position + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+class NameTable:
+    """Read-only list of gallery names decoded on demand from the offset-indexed blob."""
+
+    def __init__(self, offsets, blob):
+        self.offsets = offsets
+        self.blob = blob
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, idx):
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError(f"Name index {idx} out of range")
+        return bytes(self.blob[self.offsets[idx]:self.offsets[idx + 1]]).decode('utf-8')
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self[idx]
+
+
+def encode_names(name_list):
+    """The (N + 1) int64 offsets and uint8 utf-8 blob a NameTable reads, for any list of names."""
+    if isinstance(name_list, NameTable):
+        return np.asarray(name_list.offsets, dtype='<i8'), np.asarray(name_list.blob, dtype=np.uint8)
+    encoded = [str(name).encode('utf-8') for name in name_list]
+    offsets = np.zeros(len(encoded) + 1, dtype='<i8')
+    offsets[1:] = np.cumsum([len(name) for name in encoded])
+    return offsets, np.frombuffer(b''.join(encoded), dtype=np.uint8)
+
+
+def is_flat_gallery(path):
+    """True if path starts with the flat gallery magic rather than a torch pickle."""
+    with open(path, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def write_gallery(path, embedding_list, name_list, dtype=np.float32):
+    """Write the [embedding_list, name_list] pair from data.pt in the flat format."""
+    if len(embedding_list) != len(name_list):
+        raise ValueError(f"Gallery has {len(embedding_list)} embeddings but {len(name_list)} names")
+    dtype = np.dtype(dtype)
+    if dtype not in DTYPE_CODES:
+        raise ValueError(f"Unsupported gallery dtype: {dtype}")
+
+    if torch.is_tensor(embedding_list):
+        matrix = embedding_list.detach().reshape(len(name_list), -1).cpu().numpy()
+    else:
+        matrix = np.stack([torch.as_tensor(emb).detach().reshape(-1).cpu().numpy() for emb in embedding_list])
+    matrix = np.ascontiguousarray(matrix, dtype=dtype)
+
+    offsets, blob = encode_names(name_list)
+
+    matrix_pos = _align(HEADER.size)
+    offsets_pos = _align(matrix_pos + matrix.nbytes)
+    names_pos = offsets_pos + offsets.nbytes
+    with open(path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, VERSION, DTYPE_CODES[dtype], matrix.shape[0], matrix.shape[1],
+                            matrix_pos, offsets_pos, names_pos))
+        f.seek(matrix_pos)
+        f.write(matrix.astype(dtype.newbyteorder('<'), copy=False).tobytes())
+        f.seek(offsets_pos)
+        f.write(offsets.tobytes())
+        f.write(blob.tobytes())
+
+
+def read_gallery(path):
+    """Memory-map a flat gallery, returns [embeddings, names] like torch.load of data.pt.
+
+    The embeddings are a torch tensor backed by the page cache (copy-on-write),
+    so every worker process on the host shares one copy of a float32 gallery.
+    """
+    with open(path, 'rb') as f:
+        header = f.read(HEADER.size)
+    magic, version, dtype_code, n, d, matrix_pos, offsets_pos, names_pos = HEADER.unpack(header)
+    if magic != MAGIC:
+        raise ValueError(f"{path} is not a flat gallery file")
+    if version != VERSION:
+        raise ValueError(f"Unsupported gallery version {version} in {path}")
+    if dtype_code not in DTYPES:
+        raise ValueError(f"Unknown dtype code {dtype_code} in {path}")
+
+    dtype = np.dtype(DTYPES[dtype_code]).newbyteorder('<')
+    matrix = np.memmap(path, dtype=dtype, mode='c', offset=matrix_pos, shape=(n, d))
+    offsets = np.memmap(path, dtype='<i8', mode='r', offset=offsets_pos, shape=(n + 1,))
+    blob = np.memmap(path, dtype=np.uint8, mode='r', offset=names_pos, shape=(int(offsets[-1]),)) \
+        if offsets[-1] else np.empty(0, dtype=np.uint8)
+    return [torch.from_numpy(matrix), NameTable(offsets, blob)]
+
+
+def load_gallery(path):
+    """Load a gallery from either the flat format or a legacy pickled data.pt."""
+    if is_flat_gallery(path):
+        return read_gallery(path)
+    return torch.load(path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Convert a pickled data.pt into the flat memory-mappable gallery format')
+    parser.add_argument('source', type=str, help='legacy data.pt to convert')
+    parser.add_argument('target', type=str, help='flat gallery file to write')
+    parser.add_argument('--dtype', type=str, default='float32', choices=['float32', 'float16'], help='stored embedding precision')
+    args = parser.parse_args()
+
+    saved_data = torch.load(args.source)
+    write_gallery(args.target, saved_data[0], saved_data[1], dtype=args.dtype)
+    print(f"Wrote {len(saved_data[1])} embeddings from {args.source} to {args.target} as {args.dtype}")
@@ -0,0 +1,157 @@
+import os
+import threading
+import time
+from ann_index import IVFIndex, build_matcher
+from gallery_format import load_gallery
+
+
+class GalleryStore:
+    """Loads data.pt once per process and keeps the matcher built from it.
+
+    When a bucket/key is given the local copy is downloaded from S3 and the
+    object's ETag is re-checked at most every revalidate_seconds, so a new
+    gallery uploaded to S3 is picked up by warm workers without a redeploy.
+    index selects the matcher built over the gallery ('exact' or 'ivf'), with
+    index_options passed through to it (n_lists, nprobe, pq_subvectors, ...).
+    local_path may be a legacy pickled data.pt or a flat file written by
+    gallery_format.py, which is memory-mapped instead of deserialized.
+
+    An ivf index is read from index_path (default local_path + '.ivf.npz')
+    when that file is at least as new as the gallery, and otherwise built and
+    saved there, so k-means runs once per gallery rather than on every start.
+    With a bucket, index_key names a prebuilt index (see ann_index.py)
+    downloaded along with the gallery.
+    """
+
+    def __init__(self, local_path, bucket=None, key=None, s3_client=None, revalidate_seconds=60,
+                 index='exact', index_options=None, index_path=None, index_key=None):
+        if bucket and s3_client is None:
+            raise ValueError("An s3_client is required when the gallery is backed by a bucket")
+        self.local_path = local_path
+        self.bucket = bucket
+        self.key = key or os.path.basename(local_path)
+        self.s3_client = s3_client
+        self.revalidate_seconds = revalidate_seconds
+        self.index = index
+        self.index_options = index_options or {}
+        self.index_path = index_path or f"{local_path}.ivf.npz"
+        self.index_key = index_key
+        self.matcher = None
+        self.etag = None
+        self.loaded_at = None
+        self.last_checked = 0.0
+        self.lock = threading.Lock()
+
+    def _download(self):
+        # Download next to the live file and swap it in, so a failed transfer never leaves a partial data.pt
+        tmp_path = f"{self.local_path}.download"
+        self.s3_client.download_file(self.bucket, self.key, tmp_path)
+        os.replace(tmp_path, self.local_path)
+        print(f"Downloaded gallery {self.key} from {self.bucket} to {self.local_path}")
+        if self.index == 'ivf' and self.index_key:
+            # Downloaded after the gallery so it counts as fresh; if it is missing the index is built locally
+            try:
+                self.s3_client.download_file(self.bucket, self.index_key, f"{self.index_path}.download")
+                os.replace(f"{self.index_path}.download", self.index_path)
+                print(f"Downloaded prebuilt index {self.index_key} from {self.bucket} to {self.index_path}")
+            except Exception as e:
+                print(f"Could not download prebuilt index {self.index_key}, building it instead: {e}")
+
+    def _load_index(self, count):
+        # The saved index, if it was built from this gallery with the requested options
+        if not os.path.exists(self.index_path) or \
+                os.path.getmtime(self.index_path) < os.path.getmtime(self.local_path):
+            return None
+        try:
+            matcher = IVFIndex.load(self.index_path, nprobe=self.index_options.get('nprobe'))
+        except Exception as e:
+            print(f"Could not read index {self.index_path}, rebuilding it: {e}")
+            return None
+        n_lists = self.index_options.get('n_lists')
+        if len(matcher) != count or matcher.pq_subvectors != self.index_options.get('pq_subvectors') or \
+                (n_lists is not None and len(matcher.centroids) != n_lists):
+            print(f"Index {self.index_path} does not match the gallery or index options, rebuilding it")
+            return None
+        return matcher
+
+    def _save_index(self, matcher):
+        tmp_path = f"{self.index_path}.tmp"
+        try:
+            with open(tmp_path, 'wb') as f:
+                matcher.save(f)
+            os.replace(tmp_path, self.index_path)
+        except OSError as e:
+            print(f"Could not save index to {self.index_path}: {e}")
+
+    def _load(self):
+        start = time.time()
+        saved_data = load_gallery(self.local_path)  # flat files are mmapped, legacy data.pt is torch.load-ed
+        matcher = self._load_index(len(saved_data[1])) if self.index == 'ivf' else None
+        if matcher is None:
+            # validates names/embeddings line up
+            matcher = build_matcher(saved_data[0], saved_data[1], self.index, **self.index_options)
+            if self.index == 'ivf':
+                self._save_index(matcher)
+        self.matcher = matcher
+        self.loaded_at = time.time()
+        print(f"Loaded gallery {self.local_path} with {len(matcher)} identities ({self.index} index) "
+              f"in {self.loaded_at - start:.3f}s")
+
+    def _remote_etag(self):
+        return self.s3_client.head_object(Bucket=self.bucket, Key=self.key)['ETag']
+
+    def _refresh(self):
+        if self.bucket is None:
+            if self.matcher is None:
+                self._load()
+            return
+
+        now = time.time()
+        if self.matcher is not None and now - self.last_checked < self.revalidate_seconds:
+            return
+
+        try:
+            remote_etag = self._remote_etag()
+        except Exception as e:
+            if self.matcher is None:
+                raise
+            # Keep serving the copy we already have if S3 is briefly unreachable
+            print(f"Gallery revalidation failed, keeping current copy: {e}")
+            self.last_checked = now
+            return
+
+        self.last_checked = now
+        if self.matcher is not None and remote_etag == self.etag:
+            return
+
+        try:
+            self._download()
+            self._load()
+        except Exception as e:
+            if self.matcher is None:
+                raise
+            # last_checked is already set, so the new gallery is retried after revalidate_seconds
+            print(f"Could not load new gallery {remote_etag}, keeping current copy: {e}")
+            return
+        self.etag = remote_etag
+
+    def get(self):
+        """Return the cached matcher, loading or revalidating the gallery if needed."""
+        with self.lock:
+            self._refresh()
+            return self.matcher
+
+
+# One store per gallery path, shared by everything in this process
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def get_gallery_store(local_path, **kwargs):
+    """Return the process-wide GalleryStore for local_path, creating it on first use."""
+    with _stores_lock:
+        store = _stores.get(local_path)
+        if store is None:
+            store = GalleryStore(local_path, **kwargs)
+            _stores[local_path] = store
+        return store
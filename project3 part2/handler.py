@@ -3,17 +3,17 @@
 # __license__     = "MIT"
 
 import os
-import boto3
 import cv2
 from PIL import Image, ImageDraw, ImageFont
 from facenet_pytorch import MTCNN, InceptionResnetV1
-import torch
+from clients import get_client
+from gallery_store import GalleryStore
 
 # Initialize MTCNN and ResNet models outside the handler for efficiency
 mtcnn = MTCNN(image_size=240, margin=0, min_face_size=20)
 resnet = InceptionResnetV1(pretrained='vggface2').eval()
 
-def face_recognition_function(key_path):
+def face_recognition_function(key_path, matcher):
     # Face extraction
     img = cv2.imread(key_path, cv2.IMREAD_COLOR)
     boxes, _ = mtcnn.detect(img)
@@ -22,26 +22,32 @@ def face_recognition_function(key_path):
     key = os.path.splitext(os.path.basename(key_path))[0].split(".")[0]
     img = Image.fromarray(cv2.cvtColor(img, cv2.COLOR_BGR2RGB))
     face, prob = mtcnn(img, return_prob=True, save_path=None)
-    saved_data = torch.load('/tmp/data.pt')  # loading data.pt file
     if face != None:
         emb = resnet(face.unsqueeze(0)).detach()  # detech is to make required gradient false
-        embedding_list = saved_data[0]  # getting embedding data
-        name_list = saved_data[1]  # getting list of names
-        dist_list = []  # list of matched distances, minimum distance is used to identify the person
-        for idx, emb_db in enumerate(embedding_list):
-            dist = torch.dist(emb, emb_db).item()
-            dist_list.append(dist)
-        idx_min = dist_list.index(min(dist_list))
+        name, _ = matcher.match(emb)  # single batched distance + argmin
 
         # Save the result name in a file
         with open("/tmp/" + key + ".txt", 'w+') as f:
-            f.write(name_list[idx_min])
-        return name_list[idx_min]
+            f.write(name)
+        return name
     else:
         print(f"No face is detected")
     return
 
-s3_client = boto3.client('s3')
+# One pooled, keep-alive client per container, reused by every warm invocation
+s3_client = get_client('s3')
+
+# data.pt is downloaded and loaded once per warm container and re-checked by ETag
+data_pt_bucket = '1231674381-ccp3'
+data_pt_key = 'data.pt'
+# GALLERY_INDEX=ivf switches to approximate search for very large galleries
+gallery_index = os.environ.get('GALLERY_INDEX', 'exact')
+gallery_index_options = {'nprobe': int(os.environ.get('GALLERY_NPROBE', '8'))} if gallery_index == 'ivf' else None
+# GALLERY_INDEX_KEY names an index prebuilt with ann_index.py next to data.pt, so cold starts skip k-means
+gallery = GalleryStore('/tmp/data.pt', bucket=data_pt_bucket, key=data_pt_key,
+                       s3_client=s3_client, revalidate_seconds=60,
+                       index=gallery_index, index_options=gallery_index_options,
+                       index_key=os.environ.get('GALLERY_INDEX_KEY') or None)
 
 def handler(event, context):
     print("Face recognition Lambda function started.")
@@ -56,7 +62,6 @@ def handler(event, context):
 
     # Define local paths
     local_image_path = '/tmp/' + image_file_name
-    data_pt_local_path = '/tmp/data.pt'
     output_bucket = bucket_name.replace('-stage-1', '-output')
     output_file_name = os.path.splitext(image_file_name)[0] + '.txt'
 
@@ -68,19 +73,16 @@ def handler(event, context):
         print(f"Failed to download {image_file_name} from {bucket_name}: {e}")
         return
 
-    # Download data.pt from S3
-    data_pt_bucket = '1231674381-ccp3'
-    data_pt_key = 'data.pt'  
+    # Get the cached gallery, only downloading data.pt again if its ETag changed
     try:
-        s3_client.download_file(data_pt_bucket, data_pt_key, data_pt_local_path)
-        print(f"Downloaded data.pt from {data_pt_bucket} to {data_pt_local_path}")
+        matcher = gallery.get()
     except Exception as e:
-        print(f"Failed to download data.pt: {e}")
+        print(f"Failed to load data.pt: {e}")
         return
 
     # Perform face recognition
     try:
-        recognized_name = face_recognition_function(local_image_path)
+        recognized_name = face_recognition_function(local_image_path, matcher)
         if recognized_name:
             # Save the recognized name to a text file
             output_file_path = '/tmp/' + output_file_name
@@ -100,7 +102,6 @@ def handler(event, context):
     # Cleanup temporary files
     try:
         os.remove(local_image_path)
-        os.remove(data_pt_local_path)
         os.remove(output_file_path)
         print("Cleaned up temporary files.")
     except Exception as e: